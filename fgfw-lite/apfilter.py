@@ -24,7 +24,7 @@ import re
 import time
 from threading import Timer
 from collections import defaultdict
-from util import parse_hostport
+from util import request_context
 import config
 try:
     import urlparse
@@ -94,6 +94,7 @@ class ap_filter(object):
         self.fast = defaultdict(list)
         self.rules = set()
         self.expire = {}
+        self.expire_at = {}  # {rule: timestamp}, temp rules only
         if lst:
             for rule in lst:
                 self.add(rule)
@@ -119,6 +120,7 @@ class ap_filter(object):
         self.rules.add(rule)
         self.expire[rule] = expire
         if expire:
+            self.expire_at[rule] = time.time() + expire
             Timer(expire, self.remove, (rule, )).start()
 
     def _add_urlstartswith(self, rule):
@@ -145,16 +147,16 @@ class ap_filter(object):
         rule = rule.rstrip('/^')
         self.domains.add(rule[2:])
 
-    def match(self, url, host=None, domain_only=False):
-        if host is None:
-            if '://' in url:
-                host = urlparse.urlparse(url).hostname
-            else:  # www.google.com:443
-                host = parse_hostport(url)[0]
+    def match(self, url, host=None, domain_only=False, ctx=None):
+        '''ctx: request_context, if given, url and host are ignored'''
+        if ctx is None:
+            ctx = request_context.from_url(url, host)
+        url = ctx.url
         if self._listmatch(self.excludes, url):
             return False
-        if self._domainmatch(host) is not None:
-            return self._domainmatch(host)
+        result = self._domainmatch(ctx.suffixes)
+        if result is not None:
+            return result
         if domain_only:
             return None
         if url.startswith(self.url_startswith):
@@ -164,11 +166,10 @@ class ap_filter(object):
         if self._listmatch(self.matches, url):
             return True
 
-    def _domainmatch(self, host):
-        lst = ['.'.join(host.split('.')[i:]) for i in range(len(host.split('.')))]
-        if any(host in self.exclude_domains for host in lst):
+    def _domainmatch(self, suffixes):
+        if not self.exclude_domains.isdisjoint(suffixes):
             return False
-        if any(host in self.domains for host in lst):
+        if not self.domains.isdisjoint(suffixes):
             return True
 
     def _fastmatch(self, url):
@@ -219,6 +220,7 @@ class ap_filter(object):
                         break
             self.rules.discard(rule)
             del self.expire[rule]
+            self.expire_at.pop(rule, None)
             config.conf.stdout()
 
 
@@ -118,6 +118,9 @@ class basesocket(object):
     def setsockopt(self, level, optname, value):
         return self._sock.setsockopt(level, optname, value)
 
+    def getsockname(self):
+        return self._sock.getsockname()
+
     def fileno(self):
         return self._sock.fileno()
 
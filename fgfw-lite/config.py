@@ -15,11 +15,15 @@ try:
 except ImportError:
     from ipaddress import IPv4Address, ip_address
 
-from parent_proxy import ParentProxyList, ParentProxy
+from parent_proxy import ParentProxyList, ParentProxy, CircuitBreaker, ParentStats
 from get_proxy import get_proxy
 from redirector import redirector
-from util import SConfigParser, parse_hostport
+from state_store import state_store
+from util import SConfigParser, parse_hostport, stat_lock
 import resolver
+from connection import WARM_POOL
+from httputil import httpconn_pool
+from uplink import UPLINKS
 
 if not os.path.isfile('./userconf.ini'):
     shutil.copyfile('./userconf.sample.ini', './userconf.ini')
@@ -49,6 +53,21 @@ class Config(object):
         self.UPDATE_INTV = 6
         self.timeout = self.userconf.dgetint('fgfwproxy', 'timeout', 4)
         ParentProxy.DEFAULT_TIMEOUT = self.timeout
+        CircuitBreaker.THRESHOLD = self.userconf.dgetint('fgfwproxy', 'breaker_threshold', 3)
+        CircuitBreaker.COOLDOWN = self.userconf.dgetint('fgfwproxy', 'breaker_cooldown', 30)
+        # connect / read timeouts from p99 latency of each parent
+        ParentStats.ADAPTIVE_TIMEOUT = self.userconf.dgetbool('fgfwproxy', 'adaptive_timeout', False)
+        ParentStats.TIMEOUT_FACTOR = self.userconf.dgetfloat('fgfwproxy', 'timeout_factor', 3)
+        # seconds to wait for a slot when every parent left is at its max_conn
+        ParentProxy.QUEUE_TIMEOUT = self.userconf.dgetfloat('fgfwproxy', 'queue_timeout', 5)
+        # idle connections kept to each parent proxy, 0 to disable
+        WARM_POOL.max_size = self.userconf.dgetint('fgfwproxy', 'warmpool', 0)
+        # record wait / hold time of shared locks, see /api/locks
+        stat_lock.ENABLED = self.userconf.dgetbool('fgfwproxy', 'lock_stats', False)
+        # idle keep-alive connections reused for plain http and hxsocks
+        httpconn_pool.IDLE_TIMEOUT = self.userconf.dgetint('fgfwproxy', 'pool_idle', 300)
+        httpconn_pool.MAX_PER_UPSTREAM = self.userconf.dgetint('fgfwproxy', 'pool_max_per_host', 16)
+        httpconn_pool.MAX_SIZE = self.userconf.dgetint('fgfwproxy', 'pool_max', 256)
         self.parentlist = ParentProxyList()
         self.HOSTS = defaultdict(list)
         self.GUI = '-GUI' in sys.argv
@@ -122,6 +141,14 @@ return "PROXY %s; DIRECT";}''' % self.userconf.dget('fgfwproxy', 'pac', '')
             self.addparentproxy('direct', 'direct 0')
 
         ParentProxy.set_via(self.parentlist.direct)
+        # TCP Fast Open for plain http requests connected directly
+        if not self.parentlist.direct.proxy:
+            self.parentlist.direct.tfo = self.userconf.dgetbool('fgfwproxy', 'tfo', False)
+
+        for k, v in self.userconf.items('uplinks'):
+            UPLINKS.add(k, v)
+        # uplinks for direct connections, default all
+        self.parentlist.direct.uplink = [x for x in self.userconf.dget('fgfwproxy', 'uplink', '').split('|') if x]
 
         for k, v in self.userconf.items('parents'):
             if '6Rc59g0jFlTppvel' in v:
@@ -134,6 +161,9 @@ return "PROXY %s; DIRECT";}''' % self.userconf.dget('fgfwproxy', 'pac', '')
             self.logger.warning('No parent proxy available!')
 
         self.maxretry = self.userconf.dgetint('fgfwproxy', 'maxretry', 4)
+        self.race = self.userconf.dgetbool('fgfwproxy', 'race', False)
+        self.race_stagger = self.userconf.dgetfloat('fgfwproxy', 'race_stagger', 0.3)
+        self.hedge = self.userconf.dgetbool('fgfwproxy', 'hedge', False)
 
         def addhost(host, ip):
             if isinstance(ip, bytes):
@@ -166,10 +196,18 @@ return "PROXY %s; DIRECT";}''' % self.userconf.dget('fgfwproxy', 'pac', '')
         self.REDIRECTOR = redirector(self)
         self.PARENT_PROXY = get_proxy(self)
         bad_ip = set(self.userconf.dget('dns', 'bad_ip', '').split('|'))
+        # dns cache: answers kept for their TTL, in [min_ttl, max_ttl] seconds
+        resolver.DNS_Cache.MIN_TTL = self.userconf.dgetint('dns', 'min_ttl', 30)
+        resolver.DNS_Cache.MAX_TTL = self.userconf.dgetint('dns', 'max_ttl', 3600)
+        resolver.DNS_Cache.MAX_SIZE = self.userconf.dgetint('dns', 'cache_size', 4096)
         self.resolver = resolver.get_resolver(self.localdns, self.remotedns,
                                               proxy=ParentProxy('self', 'http://127.0.0.1:%d' % self.listen[1]),
                                               apfilter=[self.PARENT_PROXY.gfwlist, self.PARENT_PROXY.local],
                                               bad_ip=bad_ip)
+        self.STATE = None
+        if self.userconf.dgetbool('fgfwproxy', 'savestate', True):
+            self.STATE = state_store(self, interval=self.userconf.dgetint('fgfwproxy', 'savestate_intv', 300))
+            self.STATE.load()
 
     def reload(self):
         self.version.read('version.ini')
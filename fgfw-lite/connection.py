@@ -1,15 +1,28 @@
 #!/usr/bin/env python
 # coding: UTF-8
 import socket
+import errno
 import ssl
 import base64
 import struct
 import logging
-import random
+import math
 import time
+import sys
+import weakref
+from threading import Thread, Timer, RLock
+from collections import defaultdict, deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from parent_proxy import ParentProxy
+from ipstats import IP_STATS
+from uplink import UPLINKS
 from httputil import read_reaponse_line, read_header_data
+from util import is_connection_dropped, connect_deadline
+import metrics
 
 logger = logging.getLogger('conn')
 logger.setLevel(logging.INFO)
@@ -19,8 +32,18 @@ formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
 hdr.setFormatter(formatter)
 logger.addHandler(hdr)
 
+CONNECT_STAGGER = 0.25  # delay before connecting to the next address, RFC 8305 recommends 250ms
 
-def _create_connection(address, timeout=None, source_address=None, iplist=None):
+# TCP Fast Open, linux 4.11+. connect() returns at once, SYN is sent with the first write.
+TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30)
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+TCPI_OPT_SYN_DATA = 32
+TCP_ESTABLISHED = 1
+TFO_SUPPORTED = sys.platform.startswith('linux')
+_tfo_pending = weakref.WeakSet()  # sockets with TFO enabled, result not counted yet
+
+
+def _create_connection(address, timeout=None, source_address=None, iplist=None, tfo=False, link=None):
     """Connect to *address* and return the socket object.
 
     Convenience function.  Connect to *address* (a 2-tuple ``(host,
@@ -31,6 +54,13 @@ def _create_connection(address, timeout=None, source_address=None, iplist=None):
     is used.  If *source_address* is set it must be a tuple of (host, port)
     for the socket to bind as a source address before making the connection.
     An host of '' or port 0 tells the OS to use the default.
+
+    If host has more than one address, connect to them Happy Eyeballs style:
+    a new attempt starts every CONNECT_STAGGER seconds, or as soon as one fails,
+    the first connected socket is returned, others are closed.
+
+    tfo: caller writes first, TCP Fast Open may be used for known good addresses.
+    link: uplink to bind to, replaces source_address. addresses of its family are tried first.
     """
     host, port = address
     try:
@@ -39,44 +69,372 @@ def _create_connection(address, timeout=None, source_address=None, iplist=None):
     except Exception:
         def resolver(host):
             return [(i[0], i[4][0]) for i in socket.getaddrinfo(host, 0)]
-    err = None
     if not iplist:
-        iplist = resolver(host)
-    if len(iplist) > 1:
-        random.shuffle(iplist)
-        # ipv4 goes first
-        iplist = sorted(iplist, key=lambda item: item[0])
         if timeout:
-            timeout = max(timeout / 2, 2)
+            # resolving counts in timeout
+            expire = time.time() + timeout
+            iplist = _resolve(resolver, host, timeout)
+            timeout = expire - time.time()
+            if timeout <= 0:
+                raise socket.timeout('timed out')
+        else:
+            iplist = resolver(host)
+    if not iplist:
+        raise socket.error("getaddrinfo returns an empty list")
+    if link and link.source_address:
+        iplist = [item for item in iplist if item[0] == link.family] or iplist
+    if len(iplist) == 1:
+        af, addr = iplist[0]
+        return _connect(af, addr, port, timeout, source_address, tfo, link)
+    iplist = _interleave(iplist)
+
+    def on_loser(i, sock, e, winner):
+        if sock is not None:
+            sock.close()
+
+    attempts = [lambda af=af, addr=addr: _connect(af, addr, port, timeout, source_address, tfo, link) for af, addr in iplist]
+    return race(attempts, CONNECT_STAGGER, timeout, on_loser=on_loser)[1]
+
+
+def _resolve(resolver, host, timeout):
+    try:
+        socket.inet_pton(socket.AF_INET6 if ':' in host else socket.AF_INET, host)
+        return [(socket.AF_INET6 if ':' in host else socket.AF_INET, host)]
+    except (socket.error, ValueError, TypeError):
+        pass
+    return race([lambda: resolver(host)], timeout=timeout)[1]
+
+
+def _connect(af, addr, port, timeout=None, source_address=None, tfo=False, link=None):
+    sock = socket.socket(af)
+    try:
+        if timeout:
+            sock.settimeout(timeout)
+        if link:
+            link.bind(sock, af)
+        elif source_address:
+            sock.bind(source_address)
+        # a deferred connect can't fail over to the next address, only use TFO where connect is expected to work
+        tfo = tfo and IP_STATS.reliable(addr) and _enable_tfo(sock)
+        t = time.time()
+        sock.connect((addr, port))
+        if not tfo or _tcp_info(sock)[0] == TCP_ESTABLISHED:
+            # no cookie yet, a normal handshake was done
+            IP_STATS.log(addr, time.time() - t)
+        return sock
+    except Exception as e:
+        sock.close()
+        IP_STATS.failed(addr)
+        # refused: the uplink works, the other end doesn't
+        if link and getattr(e, 'errno', None) != errno.ECONNREFUSED:
+            link.failed()
+        raise
+
+
+def _enable_tfo(sock):
+    global TFO_SUPPORTED
+    if not TFO_SUPPORTED:
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+    except (socket.error, OSError) as e:
+        logger.info('TCP Fast Open not available: %r, disabled' % e)
+        TFO_SUPPORTED = False
+        return False
+    _tfo_pending.add(sock)
+    metrics.incr('tfo.sent')
+    return True
+
 
-    t = time.time() - 0.2
-    for res in iplist:
-        af, addr = res
-        sock = None
+def _tcp_info(sock):
+    '''(tcpi_state, tcpi_options)'''
+    data = bytearray(sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, 8))
+    return data[0], data[5]
+
+
+def tfo_check(sock):
+    '''
+    call after the first response is read from sock.
+    counts if data sent with SYN was accepted, or the kernel fell back to a normal handshake.
+    '''
+    try:
+        _tfo_pending.remove(sock)
+    except KeyError:
+        return
+    try:
+        accepted = _tcp_info(sock)[1] & TCPI_OPT_SYN_DATA
+    except (socket.error, OSError):
+        return
+    metrics.incr('tfo.%s' % ('hit' if accepted else 'miss'))
+
+
+def _interleave(iplist):
+    '''
+    order by connect history, then alternate families (RFC 8305 section 4),
+    starting with the family of the best address.
+    '''
+    iplist = IP_STATS.order(iplist)
+    first = [item for item in iplist if item[0] == iplist[0][0]]
+    others = [item for item in iplist if item[0] != iplist[0][0]]
+    result = []
+    for i in range(max(len(first), len(others))):
+        result.extend(lst[i] for lst in (first, others) if i < len(lst))
+    return result
+
+
+def race(attempts, stagger=0.3, timeout=None, on_loser=None):
+    '''
+    Happy Eyeballs style racing.
+
+    attempts: list of callables. attempts[0] starts first, the next one starts
+    after *stagger* seconds, or at once if a running attempt failed.
+    Return (index, result) of the first successful attempt.
+    on_loser(index, result, error, winner_index) is called for every other
+    attempt once the race is decided, late ones after race returned, so
+    results can be closed. winner_index is None if all attempts failed,
+    in which case the last error is raised.
+    '''
+    q = queue.Queue()
+    state = {'started': 0, 'pending': 0}
+
+    def run(i, func):
         try:
-            sock = socket.socket(af)
-            if timeout:
-                sock.settimeout(timeout)
-            if source_address:
-                sock.bind(source_address)
-            sock.connect((addr, port))
-            return sock
-
-        except socket.error as _:
-            err = _
-            if sock is not None:
-                sock.close()
-        if timeout and time.time() - t > timeout:
-            if err:
-                raise err
-            raise socket.error("connect timed out")
-    if err is not None:
-        raise err
-    else:
-        raise socket.error("getaddrinfo returns an empty list")
+            q.put((i, func(), None))
+        except Exception as e:
+            q.put((i, None, e))
+
+    def start_next():
+        i = state['started']
+        t = Thread(target=run, args=(i, attempts[i]))
+        t.daemon = True
+        t.start()
+        state['started'] += 1
+        state['pending'] += 1
+
+    def drain(count, winner_index):
+        for _ in range(count):
+            i, result, e = q.get()
+            if on_loser:
+                on_loser(i, result, e, winner_index)
+
+    if not attempts:
+        raise socket.error("nothing to race")
+    deadline = time.time() + timeout if timeout else None
+    winner = None
+    losers = []
+    start_next()
+    while state['pending']:
+        if state['started'] < len(attempts):
+            wait = stagger
+        elif deadline:
+            wait = deadline - time.time()
+            if wait <= 0:
+                break
+        else:
+            wait = None
+        try:
+            i, result, e = q.get(timeout=wait) if wait is not None else q.get()
+        except queue.Empty:
+            if state['started'] < len(attempts):
+                start_next()
+            continue
+        state['pending'] -= 1
+        if e is None:
+            winner = (i, result)
+            break
+        losers.append((i, result, e))
+        if state['started'] < len(attempts):
+            start_next()
+    winner_index = winner[0] if winner else None
+    if on_loser:
+        for i, result, e in losers:
+            on_loser(i, result, e, winner_index)
+    if state['pending']:
+        t = Thread(target=drain, args=(state['pending'], winner_index))
+        t.daemon = True
+        t.start()
+    if winner:
+        return winner
+    if losers:
+        raise losers[-1][2]
+    raise socket.timeout('timed out')
+
+
+DEFAULT_PORT = {'http': 80, 'https': 443, 'socks5': 1080, 'ss': 8388}
 
 
-def do_tunnel(soc, netloc, pp):
+def parent_transport(parentproxy, ctimeout, source_address=None, tfo=True, deadline=None):
+    '''
+    connection to parentproxy itself: tcp, or tls for https parents.
+    tfo: False if nothing is written soon, a deferred connect would not be made at all.
+    '''
+    port = parentproxy.port or DEFAULT_PORT.get(parentproxy.scheme, 80)
+    limit = parentproxy.adaptive_timeout('connect', None)
+    if limit:
+        deadline = connect_deadline(min(limit, deadline.remaining()) if deadline else limit)
+    t = time.time()
+    s = create_connection((parentproxy.hostname, port), ctimeout, source_address, parentproxy=parentproxy.get_via(), tunnel=True,
+                          tfo=tfo and parentproxy.tfo, uplink=parentproxy.uplink, deadline=deadline)
+    if parentproxy.scheme == 'https':
+        s = tls_handshake(s, parentproxy, deadline)
+    parentproxy.stats.log_latency(time.time() - t, 'connect')
+    return s
+
+
+def tls_handshake(s, parentproxy, deadline=None):
+    '''wrap s with the parent's SSLContext, resume the last session if python supports it'''
+    if deadline:
+        deadline.apply(s)
+    kwargs = {'server_hostname': parentproxy.hostname} if ssl.HAS_SNI else {}
+    if parentproxy.tls_session is not None:
+        kwargs['session'] = parentproxy.tls_session
+    s = parentproxy.ssl_context().wrap_socket(s, **kwargs)
+    metrics.incr('tls.handshake')
+    if hasattr(s, 'session'):
+        # python 3.6+
+        metrics.incr('tls.resume.%s' % ('hit' if s.session_reused else 'miss'))
+        parentproxy.tls_session = s.session
+    return s
+
+
+class warm_pool(object):
+    '''
+    idle transport connections to parent proxies, made before they are needed.
+    target size of each parent follows its recent demand, up to max_size.
+    connections idle for IDLE_TIMEOUT, or closed by the other side, are dropped.
+    '''
+    INTERVAL = 5
+    IDLE_TIMEOUT = 30
+    SCHEMES = ('http', 'https', 'socks5', 'ss')
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size  # 0: disabled
+        self.pool = defaultdict(deque)  # {key: deque([(sock, created), ...])}
+        self.parents = {}  # {key: parentproxy}
+        self.requests = defaultdict(int)  # gets of current interval
+        self.demand = defaultdict(float)  # EWMA of gets per interval
+        self.connecting = defaultdict(int)
+        self.lock = RLock()
+        self.timer = None
+
+    @staticmethod
+    def key(parentproxy):
+        return (parentproxy.proxy, str(parentproxy.get_via()))
+
+    def enabled(self, parentproxy):
+        return self.max_size > 0 and parentproxy.scheme in self.SCHEMES
+
+    @staticmethod
+    def dropped(sock):
+        '''
+        an idle connection is readable only if closed by the other side, except tls:
+        tls 1.3 servers send session tickets after the handshake. read them without blocking.
+        '''
+        if not is_connection_dropped([sock]):
+            return False
+        if not isinstance(sock, ssl.SSLSocket):
+            return True
+        timeout = sock.gettimeout()
+        sock.setblocking(0)
+        try:
+            # '' on close, data is not expected on an idle connection either
+            sock.recv(1)
+        except ssl.SSLWantReadError:
+            # post-handshake records only
+            return False
+        except Exception:
+            pass
+        finally:
+            sock.settimeout(timeout)
+        return True
+
+    def get(self, parentproxy, ctimeout):
+        '''return a healthy idle connection, or None'''
+        if not self.enabled(parentproxy):
+            return
+        key = self.key(parentproxy)
+        with self.lock:
+            self.parents[key] = parentproxy
+            self.requests[key] += 1
+            if self.timer is None:
+                self._sched()
+            lst = self.pool[key]
+            result = None
+            while lst:
+                sock, created = lst.popleft()
+                if time.time() - created > self.IDLE_TIMEOUT or self.dropped(sock):
+                    sock.close()
+                    continue
+                result = sock
+                break
+        metrics.incr('pool.warm.%s' % ('hit' if result else 'miss'))
+        self._refill(key)
+        if result:
+            result.settimeout(ctimeout)
+        return result
+
+    def target(self, key):
+        return min(int(math.ceil(self.demand[key])), self.max_size)
+
+    def _refill(self, key):
+        with self.lock:
+            count = self.target(key) - len(self.pool[key]) - self.connecting[key]
+            self.connecting[key] += max(count, 0)
+        for _ in range(count):
+            t = Thread(target=self._connect, args=(key, ))
+            t.daemon = True
+            t.start()
+
+    def _connect(self, key):
+        parentproxy = self.parents[key]
+        try:
+            sock = parent_transport(parentproxy, parentproxy.timeout, tfo=False)
+        except Exception as e:
+            logger.debug('warm connection to %s failed: %r' % (parentproxy.name, e))
+            return
+        finally:
+            with self.lock:
+                self.connecting[key] -= 1
+        with self.lock:
+            self.pool[key].append((sock, time.time()))
+
+    def _purge(self):
+        with self.lock:
+            for key, lst in self.pool.items():
+                keep = deque()
+                for sock, created in lst:
+                    if time.time() - created > self.IDLE_TIMEOUT or self.dropped(sock):
+                        sock.close()
+                    else:
+                        keep.append((sock, created))
+                # shrink to target, oldest first
+                while len(keep) > self.target(key):
+                    keep.popleft()[0].close()
+                self.pool[key] = keep
+
+    def _sched(self):
+        self.timer = Timer(self.INTERVAL, self._tick, ())
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _tick(self):
+        try:
+            with self.lock:
+                for key in list(self.parents):
+                    self.demand[key] = 0.7 * self.demand[key] + 0.3 * self.requests.pop(key, 0)
+            self._purge()
+            for key in list(self.parents):
+                self._refill(key)
+        finally:
+            self._sched()
+
+
+WARM_POOL = warm_pool()
+
+
+def do_tunnel(soc, netloc, pp, deadline=None):
+    if deadline:
+        deadline.apply(soc)
     s = ['CONNECT %s:%s HTTP/1.1\r\n' % (netloc[0], netloc[1]), ]
     if pp.username:
         a = '%s:%s' % (pp.username, pp.password)
@@ -90,64 +448,134 @@ def do_tunnel(soc, netloc, pp):
     read_header_data(remoterfile)
 
 
-def create_connection(netloc, ctimeout=None, source_address=None, iplist=None, parentproxy=None, tunnel=False):
+class Socks5PipelineError(IOError):
+    pass
+
+
+def _read(fp, n):
+    data = fp.read(n)
+    if len(data) < n:
+        raise IOError(0, 'socks5: connection closed during handshake')
+    return data
+
+
+def _read_pipelined(fp, n):
+    '''_read, no reply or a truncated one to a pipelined handshake is Socks5PipelineError'''
+    try:
+        return _read(fp, n)
+    except (IOError, socket.error) as e:
+        raise Socks5PipelineError(*e.args)
+
+
+def socks5_handshake(s, netloc, pp, pipeline=False, deadline=None):
+    '''
+    pipeline: greeting, auth and connect request are sent in one write.
+    if the server closes or stops answering before the connect reply, or the reply is garbled,
+    Socks5PipelineError is raised. a refused method or failed auth is a plain IOError.
+    '''
+    if deadline:
+        deadline.apply(s)
+    greeting = (b"\x05\x02\x00\x02" if pp.username else b"\x05\x01\x00") if not pipeline else (b"\x05\x01\x02" if pp.username else b"\x05\x01\x00")
+    auth = b''
+    if pp.username:
+        auth = b''.join([b"\x01",
+                         chr(len(pp.username)).encode(),
+                         pp.username.encode(),
+                         chr(len(pp.password)).encode(),
+                         pp.password.encode()])
+    request = b''.join([b"\x05\x01\x00\x03",
+                        chr(len(netloc[0])).encode(),
+                        netloc[0].encode(),
+                        struct.pack(b">H", netloc[1])])
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    fp = s.makefile('rb', 0)
+    try:
+        if pipeline:
+            s.sendall(greeting + auth + request)
+            data = _read_pipelined(fp, 2)
+            if data != (b'\x05\x02' if pp.username else b'\x05\x00'):
+                raise IOError(0, 'socks5: unexpected method %r' % data)
+            if pp.username:
+                data = _read_pipelined(fp, 2)
+                if data[1:2] != b'\x00':
+                    raise IOError(0, 'socks5: auth failed')
+            data = _read_pipelined(fp, 4)
+            if data[0:1] != b'\x05':
+                # rest of the write not read as a connect request
+                raise Socks5PipelineError(0, 'socks5: bad reply %r' % data)
+        else:
+            s.sendall(greeting)
+            data = _read(fp, 2)
+            if data == b'\x05\x02':  # basic auth
+                s.sendall(auth)
+                data = _read(fp, 2)
+            assert data[1:2] == b'\x00'  # no auth needed or auth passed
+            s.sendall(request)
+            data = _read(fp, 4)
+        assert data[1:2] == b'\x00'
+        if data[3:4] == b'\x01':  # read ipv4 addr
+            _read(fp, 4)
+        elif data[3:4] == b'\x03':  # read host addr
+            _read(fp, ord(_read(fp, 1)))
+        elif data[3:4] == b'\x04':  # read ipv6 addr
+            _read(fp, 16)
+        _read(fp, 2)  # read port
+    finally:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+
+
+def create_connection(netloc, ctimeout=None, source_address=None, iplist=None, parentproxy=None, tunnel=False, tfo=False, uplink=None, deadline=None):
+    '''
+    tfo: caller writes first, use TCP Fast Open if netloc is connected directly.
+    uplink: uplink names to choose from if netloc is connected directly, default is uplinks of parentproxy.
+    deadline: connect_deadline shared with the caller, ctimeout from now if not set.
+        the whole connection, every hop of via chain and every handshake included, is made before it.
+    '''
     if parentproxy and not isinstance(parentproxy, ParentProxy):
         logger.warning('parentproxy is not a ParentProxy instance, please check.')
         parentproxy = ParentProxy(parentproxy, parentproxy)
     ctimeout = ctimeout or parentproxy.timeout
+    deadline = deadline or connect_deadline(ctimeout)
     via = parentproxy.get_via() if parentproxy else None
     s = None
     if not parentproxy or not parentproxy.proxy:
-        return _create_connection(netloc, ctimeout, iplist=iplist)
-    elif parentproxy.scheme == 'http':
-        s = create_connection((parentproxy.hostname, parentproxy.port or 80), ctimeout, source_address, parentproxy=via, tunnel=True)
+        if uplink is None and parentproxy:
+            uplink = parentproxy.uplink
+        link = None if source_address else UPLINKS.select(uplink)
+        s = _create_connection(netloc, deadline.remaining(), source_address, iplist=iplist, tfo=tfo, link=link)
+    elif parentproxy.scheme in ('http', 'https'):
+        s = (not source_address and WARM_POOL.get(parentproxy, ctimeout)) or parent_transport(parentproxy, ctimeout, source_address, deadline=deadline)
         if tunnel:
-            do_tunnel(s, netloc, parentproxy)
-    elif parentproxy.scheme == 'https':
-        s = create_connection((parentproxy.hostname, parentproxy.port or 443), ctimeout, source_address, parentproxy=via, tunnel=True)
-        s = ssl.wrap_socket(s)
-        s.do_handshake()
-        if tunnel:
-            do_tunnel(s, netloc, parentproxy)
+            do_tunnel(s, netloc, parentproxy, deadline)
     elif parentproxy.scheme == 'ss':
         from sssocket import sssocket
         s = sssocket(parentproxy, ctimeout, via)
-        s.connect(netloc)
+        s.connect(netloc, deadline)
     elif parentproxy.scheme == 'hxs':
         from hxsocks import hxssocket
         s = hxssocket(parentproxy, ctimeout, via)
-        s.connect(netloc)
+        s.connect(netloc, deadline)
     elif parentproxy.scheme == 'sni':
-        s = create_connection((parentproxy.hostname, parentproxy.port or 443), ctimeout, source_address, parentproxy=via, tunnel=True)
+        s = create_connection((parentproxy.hostname, parentproxy.port or 443), ctimeout, source_address, parentproxy=via, tunnel=True, deadline=deadline)
     elif parentproxy.scheme == 'socks5':
-        s = create_connection((parentproxy.hostname, parentproxy.port or 1080), ctimeout, source_address, parentproxy=via, tunnel=True)
-        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        s.sendall(b"\x05\x02\x00\x02" if parentproxy.username else b"\x05\x01\x00")
-        data = s.recv(2)
-        if data == b'\x05\x02':  # basic auth
-            s.sendall(b''.join([b"\x01",
-                                chr(len(parentproxy.username)).encode(),
-                                parentproxy.username.encode(),
-                                chr(len(parentproxy.password)).encode(),
-                                parentproxy.password.encode()]))
-            data = s.recv(2)
-        assert data[1] == b'\x00'  # no auth needed or auth passed
-        s.sendall(b''.join([b"\x05\x01\x00\x03",
-                            chr(len(netloc[0])).encode(),
-                            netloc[0].encode(),
-                            struct.pack(b">H", netloc[1])]))
-        data = s.recv(4)
-        assert data[1] == b'\x00'
-        if data[3] == b'\x01':  # read ipv4 addr
-            s.recv(4)
-        elif data[3] == b'\x03':  # read host addr
-            s.recv(ord(s.recv(1)))
-        elif data[3] == b'\x04':  # read ipv6 addr
-            s.recv(16)
-        s.recv(2)  # read port
-        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+        s = (not source_address and WARM_POOL.get(parentproxy, ctimeout)) or parent_transport(parentproxy, ctimeout, source_address, deadline=deadline)
+        if parentproxy.socks5_pipeline:
+            try:
+                socks5_handshake(s, netloc, parentproxy, pipeline=True, deadline=deadline)
+            except Socks5PipelineError as e:
+                logger.warning('%s rejects pipelined socks5 handshake (%r), disabled' % (parentproxy.name, e))
+                parentproxy.socks5_pipeline = False
+                s.close()
+                # a server ignoring the pipelined bytes used up the deadline, start over
+                deadline = connect_deadline(ctimeout)
+                s = parent_transport(parentproxy, ctimeout, source_address, deadline=deadline)
+                socks5_handshake(s, netloc, parentproxy, deadline=deadline)
+        else:
+            socks5_handshake(s, netloc, parentproxy, deadline=deadline)
     else:
         raise IOError(0, 'parentproxy %s not supported!' % parentproxy.name)
     if s:
+        # handshakes left the time remaining as timeout
+        s.settimeout(ctimeout)
         return s
     raise IOError(0, 'create_connection failed!')
@@ -49,6 +49,7 @@ import json
 import ftplib
 import random
 import select
+import signal
 import socket
 import logging
 import traceback
@@ -69,11 +70,14 @@ if sys.platform.startswith('win'):
     sys.path += glob.glob('%s/Python27/*.egg' % WORKINGDIR)
 
 import config
-from util import parse_hostport, is_connection_dropped, sizeof_fmt
-from connection import create_connection
+from util import parse_hostport, is_connection_dropped, sizeof_fmt, budget, keyed_budget, request_context, connect_deadline, lock_stats
+from connection import create_connection, race, tfo_check
 from resolver import TCP_Resolver
 from parent_proxy import ParentProxy
-from httputil import read_reaponse_line, read_headers, read_header_data, httpconn_pool
+from httputil import read_reaponse_line, read_headers, read_header_data, httpconn_pool, keep_alive, hop_by_hop, remove_hop_by_hop, filter_header_data
+import metrics
+from ipstats import IP_STATS
+from uplink import UPLINKS
 try:
     import urllib.request as urllib2
     import urllib.parse as urlparse
@@ -116,6 +120,11 @@ class ClientError(OSError):
     pass
 
 
+class LocalTarget(IOError):
+    '''connecting directly to this proxy itself, or to loopback for a remote client'''
+    pass
+
+
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, level=1, conf=None):
         self.proxy_level = level
@@ -146,13 +155,16 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
     def redirect(self, url):
         self.send_response(302)
         self.send_header("Location", url)
-        self.send_header('Connection', 'keep_alive')
+        self.send_connection_header()
         self.send_header("Content-Length", '0')
         self.end_headers()
 
     def log_message(self, format, *args):
         pass
 
+    def send_connection_header(self):
+        self.send_header('Connection', 'close' if self.close_connection else 'keep-alive')
+
     def finish(self):
         """make python2 BaseHTTPRequestHandler happy"""
         try:
@@ -176,7 +188,7 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         self.send_response(code, message)
         self.send_header("Content-Type", self.error_content_type)
         self.send_header('Content-Length', str(len(content)))
-        self.send_header('Connection', 'keep_alive')
+        self.send_connection_header()
         self.end_headers()
         if self.command != 'HEAD' and code >= 200 and code not in (204, 304):
             self._wfile_write(content)
@@ -188,7 +200,7 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         if ctype:
             self.send_header('Content-type', ctype)
         self.send_header('Content-Length', str(len(msg)))
-        self.send_header('Connection', 'keep_alive')
+        self.send_connection_header()
         self.end_headers()
         if self.command != 'HEAD' and code >= 200 and code not in (204, 304):
             self._wfile_write(msg)
@@ -231,6 +243,11 @@ class ProxyHandler(HTTPRequestHandler):
     protocol_version = "HTTP/1.1"
     bufsize = 8192
     timeout = 60
+    HEDGE_BUDGET_PARENT = keyed_budget(0.1, 0.1, 10)
+    HEDGE_BUDGET_HOST = keyed_budget(0.1, 0.02, 3)
+    # retries after a parent proxy failed, earned by successful requests
+    RETRY_BUDGET = budget(0.2, 1, 20)
+    RETRY_BUDGET_PARENT = keyed_budget(0.2, 0.2, 5)
 
     def __init__(self, request, client_address, server):
         self.ssrealip = None
@@ -245,6 +262,7 @@ class ProxyHandler(HTTPRequestHandler):
 
     def handle_one_request(self):
         self._proxylist = None
+        self.ctx = None
         self.remotesoc = None
         self.retryable = True
         self.rbuffer = deque()  # client read buffer: store request body, ssl handshake package for retry. no pop method.
@@ -257,6 +275,9 @@ class ProxyHandler(HTTPRequestHandler):
         self.count = 0
         self.traffic_count = [0, 0]  # [read from client, write to client]
         self.logmethod = self.logger.info
+        self.pproxy = None
+        self._parent_state = None  # [success, start time, traffic_count snapshot]
+        self._uplink = None
         try:
             HTTPRequestHandler.handle_one_request(self)
         except NetWorkIOError as e:
@@ -270,18 +291,75 @@ class ProxyHandler(HTTPRequestHandler):
                 self.logger.debug('upload: %d, download %d' % tuple(self.traffic_count))
             if self.remotesoc:
                 self.remotesoc.close()
+            self.parent_end()
             on_finish(self)
 
     def getparent(self):
         if self._proxylist is None:
-            self._proxylist = self.conf.PARENT_PROXY.parentproxy(self.path, self.requesthost, self.command, self.rip, self.server.proxy_level)
+            size = self.conf.PARENT_PROXY.sizes.estimate(self.requesthost[0], self.path, self.headers)
+            self._proxylist = self.conf.PARENT_PROXY.parentproxy(self.path, self.requesthost, self.command, self.rip, self.server.proxy_level, size, self.ctx)
             self.logger.debug(repr(self._proxylist))
+        # if last parent is not marked success, it failed
+        self.parent_end(False)
         if not self._proxylist:
             self.ppname = ''
             self.pproxy = None
             return 1
         self.pproxy = self._proxylist.pop(0)
+        # at max_conn: overflow to next parent, wait for a slot if it is the last one
+        while not self.pproxy.stats.begin(self.pproxy.max_conn, 0 if self._proxylist else self.pproxy.QUEUE_TIMEOUT):
+            metrics.incr('parent.full.%s' % self.pproxy.name)
+            if not self._proxylist:
+                self.logger.warning('%s is at max_conn %d, no parent left' % (self.pproxy.name, self.pproxy.max_conn))
+                self.ppname = ''
+                self.pproxy = None
+                return 1
+            self.pproxy = self._proxylist.pop(0)
+        # parents with breaker open are ranked last, but still tried if nothing else is left
+        self.pproxy.breaker.allow()
         self.ppname = self.pproxy.name
+        self._parent_state = [None, time.time(), sum(self.traffic_count)]
+
+    def parent_success(self):
+        if self._parent_state:
+            self._parent_state[0] = True
+            self._uplink = UPLINKS.lookup(self.remotesoc)
+            self.RETRY_BUDGET.deposit()
+            self.RETRY_BUDGET_PARENT.deposit(self.pproxy.name)
+
+    def retry_allowed(self):
+        '''
+        may retry after current parent failed. when a busy parent breaks, retries
+        are limited to a fraction of recent successes, globally and for that parent.
+        direct and pooled connections are not limited, falling back from direct
+        is how blocked sites work.
+        '''
+        if not self._proxylist or self.pproxy is None or self.pproxy.name == 'direct' or '(pooled)' in self.ppname:
+            return True
+        if not self.RETRY_BUDGET_PARENT.withdraw(self.pproxy.name):
+            metrics.incr('retry.budget_exhausted')
+            metrics.incr('retry.budget_exhausted.%s' % self.pproxy.name)
+            return False
+        if not self.RETRY_BUDGET.withdraw():
+            self.RETRY_BUDGET_PARENT.refund(self.pproxy.name)
+            metrics.incr('retry.budget_exhausted')
+            return False
+        metrics.incr('retry.sent')
+        return True
+
+    def parent_end(self, success=None):
+        '''update stats of current parent, success is used if outcome not set'''
+        if self._parent_state and self.pproxy:
+            result, start, traffic = self._parent_state
+            self._parent_state = None
+            success = success if result is None else result
+            traffic = sum(self.traffic_count) - traffic
+            self.pproxy.stats.end(success, traffic, time.time() - start)
+            if success:
+                self.conf.PARENT_PROXY.sizes.learn(self.requesthost[0], self.path, traffic)
+                if self._uplink:
+                    self._uplink.log(traffic, time.time() - start)
+            self._uplink = None
 
     def do_GET(self):
         if isinstance(self.path, bytes):
@@ -306,10 +384,15 @@ class ProxyHandler(HTTPRequestHandler):
 
         # gather info
         self.requesthost = parse_hostport(self.headers['Host'], 80)
-        self.rip = self.conf.resolver.get_ip_address(self.requesthost[0])
+        self.ctx = request_context.from_parse(self.path, parse, self.requesthost)
+        self.rip = self.conf.resolver.lazy_ip_address(self.requesthost[0])
+        # ip address or localhost, check for api and loop now, or before connecting directly.
+        # a name is resolved now if the port is one of ours, it may be the api by hostname
+        self.rip_checked = self.rip.resolved or self.requesthost[1] in range(self.conf.listen[1], self.conf.listen[1] + self.conf.profiles)
+        self.rip.start()
 
         if self.path == '/pac':
-            if self.rip.is_loopback or str(self.rip) in self.conf.local_ip:
+            if self.rip().is_loopback or str(self.rip()) in self.conf.local_ip:
                 return self.write(msg=self.conf.PAC, ctype='application/x-ns-proxy-autoconfig')
 
         self.shortpath = '%s://%s%s%s%s' % (parse.scheme, parse.netloc, parse.path.split(':')[0], '?' if parse.query else '', ':' if ':' in parse.path else '')
@@ -334,14 +417,14 @@ class ProxyHandler(HTTPRequestHandler):
             else:
                 return self.redirect(new_url)
 
-        if self.rip.is_loopback:
+        if self.rip_checked and self.rip().is_loopback:
             if ip_address(self.client_address[0]).is_loopback:
                 if self.requesthost[1] in range(self.conf.listen[1], self.conf.listen[1] + self.conf.profiles):
                     return self.api(parse)
             else:
                 return self.send_error(403)
 
-        if str(self.rip) == self.connection.getsockname()[0]:
+        if self.rip_checked and str(self.rip()) == self.connection.getsockname()[0]:
             if self.requesthost[1] in range(self.conf.listen[1], self.conf.listen[1] + len(self.conf.userconf.dget('fgfwproxy', 'profile', '134'))):
                 if self.conf.userconf.dgetbool('fgfwproxy', 'remoteapi', False):
                     return self.api(parse)
@@ -356,9 +439,9 @@ class ProxyHandler(HTTPRequestHandler):
         if self.noxff and 'X-Forwarded-For' in self.headers:
             del self.headers['X-Forwarded-For']
 
-        for h in ['Proxy-Connection', 'Proxy-Authenticate']:
-            if h in self.headers:
-                del self.headers[h]
+        # Does the client want to close connection after this request?
+        self.close_connection = not keep_alive(self.request_version, self.headers, ('Connection', 'Proxy-Connection'))
+        remove_hop_by_hop(self.headers, keep=('Upgrade', 'Connection') if 'Upgrade' in self.headers else ())
 
         self._do_GET()
 
@@ -380,6 +463,10 @@ class ProxyHandler(HTTPRequestHandler):
                 self.close_connection = 1
                 self.conf.PARENT_PROXY.notify(self.command, self.shortpath, self.requesthost, False, self.failed_parents, self.ppname)
                 return
+            if retry and not self.retry_allowed():
+                self.logger.warning('%s %s: retry budget exhausted, not retrying' % (self.command, self.shortpath))
+                self.conf.PARENT_PROXY.notify(self.command, self.shortpath, self.requesthost, False, self.failed_parents, self.ppname)
+                return self.send_error(503, 'Retry budget exhausted')
             if self.getparent():
                 self.conf.PARENT_PROXY.notify(self.command, self.shortpath, self.requesthost, False, self.failed_parents, self.ppname)
                 return self.send_error(504)
@@ -390,24 +477,6 @@ class ProxyHandler(HTTPRequestHandler):
                 iplist = self.conf.HOSTS.get(self.requesthost[0])
                 self._proxylist.insert(0, self.pproxy)
             self.set_timeout()
-            self.remotesoc = self._http_connect_via_proxy(self.requesthost, iplist)
-            self.wbuffer = deque()
-            self.wbuffer_size = 0
-            # send request header
-            s = []
-            if self.pproxy.proxy.startswith('http'):
-                s.append('%s %s %s\r\n' % (self.command, self.path, self.request_version))
-                if self.pproxy.username:
-                    a = '%s:%s' % (self.pproxy.username, self.pproxy.password)
-                    self.headers['Proxy-Authorization'] = 'Basic %s' % base64.b64encode(a.encode())
-            else:
-                s.append('%s /%s %s\r\n' % (self.command, '/'.join(self.path.split('/')[3:]), self.request_version))
-            # Does the client want to close connection after this request?
-            conntype = self.headers.get('Connection', "")
-            if self.request_version >= b"HTTP/1.1":
-                self.close_connection = 'close' in conntype.lower()
-            else:
-                self.close_connection = 'keep_alive' in conntype.lower()
             if 'Upgrade' in self.headers:
                 if 'websocket' in self.headers['Upgrade']:
                     self.headers['Upgrade'] = 'websocket'
@@ -416,33 +485,57 @@ class ProxyHandler(HTTPRequestHandler):
                     self.logger.warning('unsupported Upgrade header found! (%s)' % self.headers['Upgrade'])
                     del self.headers['Upgrade']
             else:
-                self.headers['Connection'] = 'keep_alive'
-
-            for k, v in self.headers.items():
-                if isinstance(v, bytes):
-                    v = v.decode('latin1')
-                s.append("%s: %s\r\n" % ("-".join([w.capitalize() for w in k.split("-")]), v))
-            s.append("\r\n")
-            data = ''.join(s).encode('latin1')
-            self.remotesoc.sendall(data)
-            self.traffic_count[0] += len(data)
-            # Now remotesoc is connected, set read timeout
-            self.remotesoc.settimeout(self.rtimeout)
-            remoterfile = self.remotesoc.makefile('rb', 0)
-            # Expect
+                self.headers['Connection'] = 'keep-alive'
+
+            rtime = 0
             skip = False
-            if 'Expect' in self.headers:
-                try:
-                    response_line, protocol_version, response_status, response_reason = read_reaponse_line(remoterfile)
-                except Exception as e:
-                    # TODO: probably the server don't handle Expect well.
-                    self.logger.warning('read response line error: %r' % e)
-                else:
-                    if response_status == 100:
-                        hdata = read_header_data(remoterfile)
-                        self._wfile_write(response_line + hdata)
+            self.remotesoc = self._pooled_connection()
+            second = self.remotesoc is None and self.race_enabled(iplist)
+            if second and self.command in ('GET', 'HEAD') and\
+                    not any(h in self.headers for h in ('Content-Length', 'Transfer-Encoding', 'Expect', 'Upgrade')):
+                # no request body, response line is read in race, skip to response headers
+                i, (self.remotesoc, remoterfile, response, rtime) = self._race(self._race_GET_attempt, second)
+                metrics.incr('race.win.%s' % ('direct' if self.pproxy.name == 'direct' else 'proxy'))
+                response_line, protocol_version, response_status, response_reason = response
+                self.upstream_name = self.ppname if self.pproxy.proxy.startswith('http') else self.requesthost
+                skip = True
+            else:
+                if self.remotesoc is None:
+                    self.remotesoc = self._connect_via_proxy(self.requesthost, iplist)
+                # send request header
+                data = self.request_header_data(self.pproxy)
+                self.remotesoc.sendall(data)
+                self.traffic_count[0] += len(data)
+                # response time counts from here, or from the end of request body
+                timelog = time.time()
+                # Now remotesoc is connected, set read timeout
+                self.remotesoc.settimeout(self.rtimeout)
+                remoterfile = self.remotesoc.makefile('rb', 0)
+                second = self.hedge_enabled()
+                # Expect
+                if 'Expect' in self.headers:
+                    try:
+                        response_line, protocol_version, response_status, response_reason = read_reaponse_line(remoterfile)
+                    except Exception as e:
+                        # TODO: probably the server don't handle Expect well.
+                        self.logger.warning('read response line error: %r' % e)
                     else:
+                        if response_status == 100:
+                            hdata = read_header_data(remoterfile)
+                            self._wfile_write(response_line + hdata)
+                        else:
+                            skip = True
+                elif second:
+                    self.HEDGE_BUDGET_HOST.deposit(self.requesthost[0])
+                    self.HEDGE_BUDGET_PARENT.deposit(self.pproxy.name)
+                    result = self._hedge(remoterfile, second, timelog)
+                    if result:
+                        self.remotesoc, remoterfile, response, rtime = result
+                        response_line, protocol_version, response_status, response_reason = response
+                        self.upstream_name = self.ppname if self.pproxy.proxy.startswith('http') else self.requesthost
                         skip = True
+            self.wbuffer = deque()
+            self.wbuffer_size = 0
             # send request body
             if not skip:
                 content_length = int(self.headers.get('Content-Length', 0))
@@ -467,6 +560,7 @@ class ProxyHandler(HTTPRequestHandler):
                         if req_body_len > 102400:
                             self.retryable = False
                             self.rbuffer = deque()
+                    timelog = time.time()
                 elif content_length > 0:
                     if content_length > 102400:
                         self.retryable = False
@@ -482,23 +576,24 @@ class ProxyHandler(HTTPRequestHandler):
                         if self.retryable:
                             self.rbuffer.append(data)
                         self.remotesoc.sendall(data)
+                    timelog = time.time()
                 # read response line
-                timelog = time.clock()
                 response_line, protocol_version, response_status, response_reason = read_reaponse_line(remoterfile)
-                rtime = time.clock() - timelog
+                rtime = time.time() - timelog
+            tfo_check(self.remotesoc)
             # read response headers
             while response_status == 100:
                 hdata = read_header_data(remoterfile)
                 self._wfile_write(response_line + hdata)
                 response_line, protocol_version, response_status, response_reason = read_reaponse_line(remoterfile)
             header_data, response_header = read_headers(remoterfile)
-            conntype = response_header.get('Connection', "")
-            if protocol_version >= b"HTTP/1.1":
-                remote_close = 'close' in conntype.lower()
-            else:
-                remote_close = 'keep_alive' in conntype.lower()
+            remote_close = not keep_alive(protocol_version, response_header)
             if 'Upgrade' in response_header:
                 self.close_connection = remote_close = True
+            elif not (self.command == 'HEAD' or response_status in (204, 304) or 'Content-Length' in response_header or
+                      response_header.get('Transfer-Encoding', 'identity') != 'identity'):
+                # body ends when connection closes
+                self.close_connection = remote_close = True
             if "Content-Length" in response_header:
                 if "," in response_header["Content-Length"]:
                     # Proxies sometimes cause Content-Length headers to get
@@ -512,6 +607,10 @@ class ProxyHandler(HTTPRequestHandler):
                 content_length = int(response_header["Content-Length"])
             else:
                 content_length = None
+            if 'Upgrade' not in response_header:
+                # connection headers of upstream are not for the client
+                conn = b'Connection: close\r\n' if self.close_connection else b'Connection: keep-alive\r\n'
+                header_data = filter_header_data(header_data, hop_by_hop(response_header), conn)
             self.wfile_write(response_line)
             self.wfile_write(header_data)
             # verify
@@ -565,6 +664,7 @@ class ProxyHandler(HTTPRequestHandler):
             self.wfile_write()
             self.conf.PARENT_PROXY.notify(self.command, self.shortpath, self.requesthost, True if response_status < 400 else False, self.failed_parents, self.ppname, rtime)
             self.pproxy.log(self.requesthost[0], rtime)
+            self.parent_success()
             if remote_close or is_connection_dropped([self.remotesoc]):
                 try:
                     self.remotesoc.close()
@@ -577,13 +677,15 @@ class ProxyHandler(HTTPRequestHandler):
                 self.connection.close()
         except ClientError as e:
             raise
+        except LocalTarget:
+            return self.send_error(403)
         except NetWorkIOError as e:
             return self.on_GET_Error(e)
 
     def on_GET_Error(self, e):
         if self.ppname:
             self.logger.warning('{} {} via {} failed: {}'.format(self.command, self.shortpath, self.ppname, repr(e)))
-            self.pproxy.log(self.requesthost[0], 5)
+            self.pproxy.log(self.requesthost[0], 5, failed=True)
             return self._do_GET(True)
         self.conf.PARENT_PROXY.notify(self.command, self.shortpath, self.requesthost, False, self.failed_parents, self.ppname)
         return self.send_error(504)
@@ -599,6 +701,7 @@ class ProxyHandler(HTTPRequestHandler):
 
         if 'Host' not in self.headers:
             self.headers['Host'] = self.path
+        self.ctx = request_context.from_url(self.path, host)
         # redirector
         new_url = self.conf.PARENT_PROXY.redirect(self)
         if new_url:
@@ -611,9 +714,11 @@ class ProxyHandler(HTTPRequestHandler):
                 self._proxylist = [self.conf.parentlist.get(u) for u in new_url.split()]
                 random.shuffle(self._proxylist)
 
-        self.rip = self.conf.resolver.get_ip_address(self.requesthost[0])
+        self.rip = self.conf.resolver.lazy_ip_address(self.requesthost[0])
+        self.rip_checked = self.rip.resolved
+        self.rip.start()
 
-        if self.rip.is_loopback:
+        if self.rip_checked and self.rip().is_loopback:
             if ip_address(self.client_address[0]).is_loopback:
                 if self.requesthost[1] in range(self.conf.listen[1], self.conf.listen[1] + self.conf.profiles):
                     # prevent loop
@@ -627,9 +732,13 @@ class ProxyHandler(HTTPRequestHandler):
         self.logger.debug('_do_CONNECT')
         if retry:
             self.failed_parents.append(self.ppname)
-            self.pproxy.log(self.requesthost[0], 5)
+            self.pproxy.log(self.requesthost[0], 5, failed=True)
         if self.remotesoc:
             self.remotesoc.close()
+        if retry and self.retryable and not self.retry_allowed():
+            self.logger.warning('%s %s: retry budget exhausted, not retrying' % (self.command, self.path))
+            self.conf.PARENT_PROXY.notify(self.command, self.path, self.path, False, self.failed_parents, self.ppname)
+            return
         if not self.retryable or self.getparent():
             self.conf.PARENT_PROXY.notify(self.command, self.path, self.path, False, self.failed_parents, self.ppname)
             return
@@ -638,21 +747,46 @@ class ProxyHandler(HTTPRequestHandler):
             iplist = self.conf.HOSTS.get(self.requesthost[0])
             self._proxylist.insert(0, self.pproxy)
         self.set_timeout()
-        self.logger.debug('create connection')
-        try:
-            self.remotesoc = self._connect_via_proxy(self.requesthost, iplist, tunnel=True)
-            self.remotesoc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        except NetWorkIOError as e:
-            self.logger.warning('%s %s via %s failed on connect! %r' % (self.command, self.path, self.ppname, e))
-            return self._do_CONNECT(True)
-        self.logger.debug('%s connected' % self.path)
         count = 0
-        if self.rbuffer:
-            self.logger.debug('write rbuffer')
-            self.remotesoc.sendall(b''.join(self.rbuffer))
-            count = 1
-            timelog = time.clock()
         rtime = 0
+        second = self.race_enabled(iplist)
+        if second and not self.rbuffer:
+            # wait for client data (tls client hello), race on the first response
+            ins, _, _ = select.select([self.connection], [], [], 1)
+            if ins:
+                data = self.connection_recv(self.bufsize)
+                if not data:
+                    return
+                self.rbuffer.append(data)
+        if second and self.rbuffer:
+            try:
+                i, (self.remotesoc, data, rtime) = self._race(self._race_CONNECT_attempt, second)
+                metrics.incr('race.win.%s' % ('direct' if self.pproxy.name == 'direct' else 'proxy'))
+            except LocalTarget:
+                # 200 Connection established is sent, just close
+                return
+            except NetWorkIOError as e:
+                self.logger.warning('%s %s via %s failed on race! %r' % (self.command, self.path, self.ppname, e))
+                return self._do_CONNECT(True)
+            count = 1
+            # not retryable from now on
+            self._wfile_write(data)
+        else:
+            self.logger.debug('create connection')
+            try:
+                self.remotesoc = self._connect_via_proxy(self.requesthost, iplist, tunnel=True)
+                self.remotesoc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except LocalTarget:
+                return
+            except NetWorkIOError as e:
+                self.logger.warning('%s %s via %s failed on connect! %r' % (self.command, self.path, self.ppname, e))
+                return self._do_CONNECT(True)
+            self.logger.debug('%s connected' % self.path)
+            if self.rbuffer:
+                self.logger.debug('write rbuffer')
+                self.remotesoc.sendall(b''.join(self.rbuffer))
+                count = 1
+                timelog = time.time()
         fds = [self.connection, self.remotesoc]
         while self.retryable:
             try:
@@ -675,7 +809,7 @@ class ProxyHandler(HTTPRequestHandler):
                     # Now remotesoc is connected, set read timeout
                     self.remotesoc.settimeout(self.rtimeout)
                     count += 1
-                    timelog = time.clock()
+                    timelog = time.time()
                     if self.retryable:
                         self.rbuffer.append(data)
                 if self.remotesoc in ins:
@@ -686,7 +820,7 @@ class ProxyHandler(HTTPRequestHandler):
                         reason = 'remote closed'
                         fds.remove(self.remotesoc)
                         break
-                    rtime = time.clock() - timelog
+                    rtime = time.time() - timelog
                     self._wfile_write(data)
             except NetWorkIOError as e:
                 self.logger.warning('do_CONNECT error: %r on %s %s' % (e, reason, count))
@@ -704,6 +838,7 @@ class ProxyHandler(HTTPRequestHandler):
         self.rbuffer = deque()
         self.conf.PARENT_PROXY.notify(self.command, self.path, self.requesthost, True, self.failed_parents, self.ppname, rtime)
         self.pproxy.log(self.requesthost[0], rtime)
+        self.parent_success()
         """forward socket"""
         try:
             while fds:
@@ -759,16 +894,19 @@ class ProxyHandler(HTTPRequestHandler):
 
     def set_timeout(self):
         if self._proxylist:
+            # conf.timeout, or from latency of this parent if adaptive_timeout is set
+            rtimeout = self.pproxy.adaptive_timeout('first_byte', self.conf.timeout)
+            ctimeout = self.pproxy.adaptive_timeout('handshake', self.conf.timeout)
             if self.ppname == 'direct':
-                self.rtimeout = self.conf.timeout
-                self.ctimeout = self.conf.timeout
+                self.rtimeout = rtimeout
+                self.ctimeout = ctimeout
             else:
-                self.rtimeout = min(2 ** len(self.failed_parents) + self.conf.timeout, 20)
-                self.ctimeout = min(2 ** len(self.failed_parents) + self.conf.timeout, 20)
+                self.rtimeout = min(2 ** len(self.failed_parents) + rtimeout, 20)
+                self.ctimeout = min(2 ** len(self.failed_parents) + ctimeout, 20)
         else:
             self.ctimeout = self.rtimeout = 20
 
-    def _http_connect_via_proxy(self, netloc, iplist):
+    def _pooled_connection(self):
         if not self.failed_parents:
             result = self.HTTPCONN_POOL.get(self.upstream_name)
             if result:
@@ -776,11 +914,209 @@ class ProxyHandler(HTTPRequestHandler):
                 sock, self.ppname = result
                 self.on_conn_log()
                 return sock
-        return self._connect_via_proxy(netloc, iplist)
 
-    def _connect_via_proxy(self, netloc, iplist=None, tunnel=False):
-        self.on_conn_log()
-        return create_connection(netloc, ctimeout=self.ctimeout, iplist=iplist, parentproxy=self.pproxy, tunnel=tunnel)
+    def local_target(self, iplist):
+        '''connecting directly to iplist, is host this proxy itself, or loopback requested by remote client'''
+        for _, addr in iplist:
+            ip = ip_address(unicode(addr))
+            if ip.is_loopback and not ip_address(self.client_address[0]).is_loopback:
+                return True
+            if ip.is_loopback or addr == self.connection.getsockname()[0]:
+                if self.requesthost[1] in range(self.conf.listen[1], self.conf.listen[1] + self.conf.profiles):
+                    return True
+        return False
+
+    def _connect_via_proxy(self, netloc, iplist=None, tunnel=False, pproxy=None):
+        if pproxy is None:
+            pproxy = self.pproxy
+            self.on_conn_log()
+        # resolving, connecting and handshakes of all hops share ctimeout
+        deadline = connect_deadline(self.ctimeout)
+        t = time.time()
+        try:
+            if not pproxy.proxy and netloc == self.requesthost:
+                if not iplist:
+                    # resolved for routing, don't resolve again
+                    iplist = (self.rip.iplist if self.rip.resolved else race([lambda: self.rip.iplist], timeout=deadline.remaining())[1]) or None
+                # checked here, not before choosing parents: the address may not be resolved yet
+                if iplist and not self.rip_checked and self.local_target(iplist):
+                    raise LocalTarget(0, 'local target: %s' % netloc[0])
+            # a tunnel may carry a protocol where the server speaks first, no TCP Fast Open
+            soc = create_connection(netloc, ctimeout=self.ctimeout, iplist=iplist, parentproxy=pproxy, tunnel=tunnel,
+                                    tfo=pproxy.tfo and not tunnel, deadline=deadline)
+        except NetWorkIOError as e:
+            if isinstance(e, socket.timeout):
+                # took at least this long, or adaptive timeout would never grow
+                pproxy.stats.log_latency(self.ctimeout, 'handshake')
+            if pproxy.proxy:
+                pproxy.breaker.failure()
+            raise
+        pproxy.stats.log_latency(time.time() - t, 'handshake')
+        if pproxy.proxy:
+            pproxy.breaker.success()
+        return soc
+
+    def request_header_data(self, pproxy):
+        s = []
+        if pproxy.proxy.startswith('http'):
+            s.append('%s %s %s\r\n' % (self.command, self.path, self.request_version))
+        else:
+            s.append('%s /%s %s\r\n' % (self.command, '/'.join(self.path.split('/')[3:]), self.request_version))
+        for k, v in self.headers.items():
+            if k.lower() == 'proxy-authorization':
+                continue
+            if isinstance(v, bytes):
+                v = v.decode('latin1')
+            s.append("%s: %s\r\n" % ("-".join([w.capitalize() for w in k.split("-")]), v))
+        if pproxy.proxy.startswith('http') and pproxy.username:
+            a = '%s:%s' % (pproxy.username, pproxy.password)
+            s.append('Proxy-Authorization: Basic %s\r\n' % base64.b64encode(a.encode()).decode())
+        s.append("\r\n")
+        return ''.join(s).encode('latin1')
+
+    def race_enabled(self, iplist=None):
+        '''the parent to race with, None if not enabled'''
+        if self.conf.race and not self.failed_parents and iplist is None and self.retryable:
+            return self.second_parent()
+
+    def second_parent(self):
+        '''next parent in proxylist, not the current one, not at max_conn'''
+        for p in self._proxylist:
+            if p is not self.pproxy and not p.full():
+                return p
+
+    def _race(self, attempt, second, first=None, stagger=None, cancelled=()):
+        '''
+        connect via current parent and second concurrently,
+        return index and attempt(parent) of the one yields usable data first, the other one is closed.
+        first: optional callable, replace attempt(self.pproxy)
+        cancelled: index of attempts stopped by caller after losing, not counted as failed
+        '''
+        self._proxylist.remove(second)
+        candidates = [self.pproxy, second]
+        second.breaker.allow()
+        candidates[1].stats.begin()
+        self._parent_state = None
+        start, traffic = time.time(), sum(self.traffic_count)
+        self.logmethod('{} {} via {} (race)'.format(self.command, self.shortpath or self.path, ' | '.join(p.name for p in candidates)))
+
+        def on_loser(i, result, e, winner):
+            parent = candidates[i]
+            if i in cancelled or isinstance(e, LocalTarget):
+                # slow, or not to be connected directly. not failed
+                parent.stats.end(None)
+                if result:
+                    try:
+                        result[0].close()
+                    except Exception:
+                        pass
+                return
+            parent.stats.end(False if e else None)
+            if e:
+                self.logger.debug('race: %s %s via %s failed: %r' % (self.command, self.shortpath or self.path, parent.name, e))
+                parent.log(self.requesthost[0], 5, failed=True)
+                if winner is not None and parent.name == 'direct':
+                    self.conf.PARENT_PROXY.notify(self.command, self.shortpath or self.path, self.requesthost, True, ['direct'], candidates[winner].name)
+            elif result:
+                parent.log(self.requesthost[0], result[-1])
+                try:
+                    result[0].close()
+                except Exception:
+                    pass
+
+        attempts = [first or (lambda: attempt(candidates[0])), lambda: attempt(candidates[1])]
+        try:
+            i, result = race(attempts, self.conf.race_stagger if stagger is None else stagger, on_loser=on_loser)
+        except NetWorkIOError:
+            self.failed_parents.append(candidates[0].name)
+            self.pproxy, self.ppname = candidates[1], candidates[1].name
+            raise
+        self.pproxy, self.ppname = candidates[i], candidates[i].name
+        self._parent_state = [None, start, traffic]
+        self.logger.debug('race: %s %s won by %s' % (self.command, self.shortpath or self.path, self.ppname))
+        return i, result
+
+    def hedge_enabled(self):
+        '''the parent to hedge with, None if not enabled'''
+        if self.conf.hedge and self.command in ('GET', 'HEAD') and self.retryable and not self.rbuffer and\
+                not any(h in self.headers for h in ('Content-Length', 'Transfer-Encoding', 'Expect', 'Upgrade')):
+            return self.second_parent()
+
+    def _hedge(self, remoterfile, second, timelog):
+        '''
+        request is sent at timelog, if response line is not received in p95 of response time,
+        send the same request via second, use the one responds first.
+        '''
+        delay = self.pproxy.stats.percentile(95)
+        if not delay:
+            # no data
+            return
+        delay = max(delay, 0.2)
+        ins, _, _ = select.select([self.remotesoc], [], [], max(timelog + delay - time.time(), 0))
+        if ins:
+            return
+        host = self.requesthost[0]
+        if not self.HEDGE_BUDGET_HOST.withdraw(host):
+            metrics.incr('hedge.budget_exhausted')
+            return
+        if not self.HEDGE_BUDGET_PARENT.withdraw(self.pproxy.name):
+            self.HEDGE_BUDGET_HOST.refund(host)
+            metrics.incr('hedge.budget_exhausted')
+            return
+        metrics.incr('hedge.sent')
+        primary = self.remotesoc
+
+        def wait_primary():
+            try:
+                response = read_reaponse_line(remoterfile)
+            except Exception:
+                # shut down after losing, or failed
+                remoterfile.close()
+                primary.close()
+                raise
+            return primary, remoterfile, response, time.time() - timelog
+
+        cancelled = set()
+        i, result = self._race(self._race_GET_attempt, second, first=wait_primary, stagger=0, cancelled=cancelled)
+        if i:
+            metrics.incr('hedge.win')
+            cancelled.add(0)
+            # wake up the thread still waiting on primary
+            try:
+                primary.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+        return result
+
+    def _race_GET_attempt(self, pproxy):
+        soc = self._connect_via_proxy(self.requesthost, pproxy=pproxy)
+        try:
+            data = self.request_header_data(pproxy)
+            soc.sendall(data)
+            soc.settimeout(self.rtimeout)
+            remoterfile = soc.makefile('rb', 0)
+            timelog = time.time()
+            response = read_reaponse_line(remoterfile)
+            return soc, remoterfile, response, time.time() - timelog
+        except Exception:
+            soc.close()
+            raise
+
+    def _race_CONNECT_attempt(self, pproxy):
+        soc = self._connect_via_proxy(self.requesthost, tunnel=True, pproxy=pproxy)
+        try:
+            soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            timelog = time.time()
+            if self.rbuffer:
+                soc.sendall(b''.join(self.rbuffer))
+            soc.settimeout(self.rtimeout)
+            data = soc.recv(self.bufsize)
+            if not data:
+                raise IOError(0, 'remote closed')
+            return soc, data, time.time() - timelog
+        except Exception:
+            soc.close()
+            raise
 
     def do_FTP(self):
         self.logger.info('{} {}'.format(self.command, self.path))
@@ -802,7 +1138,7 @@ class ProxyHandler(HTTPRequestHandler):
                         return self.redirect('%s/' % self.path)
                     self.send_response(200)
                     self.send_header('Content-Length', lst[0].split()[4])
-                    self.send_header('Connection', 'keep_alive')
+                    self.send_connection_header()
                     self.end_headers()
                     ftp.retrbinary("RETR %s" % urlunquote(p.path), self._wfile_write, self.bufsize)
                     ftp.quit()
@@ -893,7 +1229,7 @@ class ProxyHandler(HTTPRequestHandler):
                 rule = urlparse.parse_qs(parse.query).get('rule', [''])[0]
                 if rule:
                     assert base64.urlsafe_b64decode(rule) == self.conf.REDIRECTOR.redirlst[int(parse.path[16:])][0].rule
-                rule, dest = self.conf.REDIRECTOR.redirlst.pop(int(parse.path[16:]))
+                rule, dest = self.conf.REDIRECTOR.remove_redirect(int(parse.path[16:]))
                 self.write(200, json.dumps([int(parse.path[16:]), rule.rule, dest]), 'application/json')
                 return self.conf.stdout()
             except Exception as e:
@@ -903,6 +1239,24 @@ class ProxyHandler(HTTPRequestHandler):
             data = sorted(data, key=lambda item: item[0])
             data = json.dumps(sorted(data, key=lambda item: item[2]))
             return self.write(200, data, 'application/json')
+        elif parse.path == '/api/parent/score' and self.command == 'GET':
+            'optional query: command, host, size'
+            query = urlparse.parse_qs(parse.query)
+            command = query.get('command', ['GET'])[0].upper()
+            host = query.get('host', [None])[0]
+            size = int(query['size'][0]) if 'size' in query else (self.conf.PARENT_PROXY.sizes.estimate(host) if host else None)
+            data = {'scorer': self.conf.PARENT_PROXY.scorer.name,
+                    'size': size,
+                    'parents': self.conf.PARENT_PROXY.score_breakdown(command, host, self.conf.resolver.get_ip_address(host) if host else None, size)}
+            return self.write(200, json.dumps(data), 'application/json')
+        elif parse.path == '/api/metrics' and self.command == 'GET':
+            return self.write(200, json.dumps(metrics.snapshot()), 'application/json')
+        elif parse.path == '/api/ipstats' and self.command == 'GET':
+            return self.write(200, json.dumps(IP_STATS.dump()), 'application/json')
+        elif parse.path == '/api/uplinks' and self.command == 'GET':
+            return self.write(200, json.dumps(UPLINKS.dump()), 'application/json')
+        elif parse.path == '/api/locks' and self.command == 'GET':
+            return self.write(200, json.dumps(lock_stats()), 'application/json')
         elif parse.path == '/api/parent' and self.command == 'POST':
             'accept a json encoded tuple: (str rule, str dest)'
             name, proxy = json.loads(body)
@@ -1063,7 +1417,12 @@ def update(conf, logger, auto=False):
     if not conf.GUI:
         for item in subprocess_handler.ITEMS:
             item.restart()
+    if conf.STATE:
+        conf.STATE.save()
     conf.PARENT_PROXY.config()
+    if conf.STATE:
+        # parents are kept, only temp rules are lost on reload
+        conf.STATE.load(rules_only=True)
     if count:
         logger.info('Update Completed, %d file Updated.' % count)
     if conf.userconf.dget('FGFW_Lite', 'updatecmd', ''):
@@ -1122,6 +1481,14 @@ class subprocess_handler(object):
 def atexit_do():
     for item in subprocess_handler.ITEMS:
         item.stop()
+    if config.conf.STATE:
+        config.conf.STATE.save()
+
+
+def on_exit(signum=None, frame=None):
+    # server threads are not daemonic, atexit would never run
+    atexit_do()
+    os._exit(0)
 
 
 def main():
@@ -1174,10 +1541,13 @@ def main():
             logger.error(repr(e))
             logger.error(traceback.format_exc() + '\n')
     conf.stdout()
-    t.join()
+    signal.signal(signal.SIGTERM, on_exit)
+    while t.is_alive():
+        # join with timeout, so signals can be handled
+        t.join(1)
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        sys.exit(0)
+        on_exit()
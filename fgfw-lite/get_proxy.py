@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 # coding:utf-8
 import base64
-import random
 import logging
 
 from repoze.lru import lru_cache
 
 from apfilter import ap_rule, ap_filter
-from util import ip_to_country_code
+from scorer import get_scorer
+from util import ip_to_country_code, base_domain, hash_ring, request_context
+from transfer_size import size_estimator
 
 
 ASIA = ('AE', 'AF', 'AL', 'AZ', 'BD', 'BH', 'BN', 'BT', 'CN', 'CY', 'HK', 'ID',
@@ -45,6 +46,12 @@ class get_proxy(object):
         self.gfwlist = ap_filter()
         self.local = ap_filter()
         self.ignore = ap_filter()  # used by rules like "||twimg.com auto"
+        self.scorer = get_scorer(self.conf.userconf.dget('fgfwproxy', 'scoring', 'classic'), self.conf)
+        # sticky: '', 'host' or 'domain'. pin each host / domain to one parent, for connection reuse
+        self.sticky = self.conf.userconf.dget('fgfwproxy', 'sticky', '')
+        self.sticky_margin = self.conf.userconf.dgetfloat('fgfwproxy', 'sticky_margin', 5)
+        self._ring = hash_ring()
+        self.sizes = size_estimator()
 
         for line in open('./fgfw-lite/local.txt'):
             rule, _, dest = line.strip().partition(' ')
@@ -116,13 +123,37 @@ class get_proxy(object):
         except Exception:
             pass
 
-    def ifgfwed(self, uri, host, port, ip, level=1):
+    def ifgfwed(self, uri, host, port, ip, level=1, ctx=None):
+        '''
+        ip: ip_address, or a callable returning it, called only if rules below need it
+        ctx: request_context of uri
+        '''
         if level == 0:
             return False
 
         if self.conf.rproxy:
             return None
 
+        if ctx is None:
+            ctx = request_context.from_url(uri, host)
+        gfwlist = self.conf.userconf.dgetbool('fgfwproxy', 'gfwlist', True)
+
+        rules = None
+        if callable(ip) and not ip.literal and level != 4:
+            # a name that local rules or gfwlist send to a parent is not resolved. the only
+            # difference from the order below: it is not sent direct if it resolves to a
+            # private address, for gfwlist names that is likely a poisoned answer anyway.
+            rules = self._rules(uri, ctx)
+            a, ignored = rules
+            if a:
+                return True
+            if a is None and not ignored and not self.conf.region and level in (1, 2) and\
+                    not self.conf.HOSTS.get(host) and gfwlist and self.gfwlist.match(uri, ctx=ctx):
+                return True
+
+        if callable(ip):
+            ip = ip()
+
         if int(ip) == 0:
             return True
 
@@ -132,11 +163,11 @@ class get_proxy(object):
         if level == 4:
             return True
 
-        a = self.local.match(uri, host)
+        a, ignored = rules or self._rules(uri, ctx)
         if a is not None:
             return a
 
-        if self.ignore.match(uri, host):
+        if ignored:
             return None
 
         if level == 2 and uri.startswith('http://'):
@@ -148,10 +179,15 @@ class get_proxy(object):
         if level == 3:
             return True
 
-        if self.conf.userconf.dgetbool('fgfwproxy', 'gfwlist', True) and self.gfwlist.match(uri, host):
+        if gfwlist and self.gfwlist.match(uri, ctx=ctx):
             return True
 
-    def parentproxy(self, uri, host, command, ip, level=1):
+    def _rules(self, uri, ctx):
+        '''result of local rules, and if no local rule matches, whether ignored'''
+        a = self.local.match(uri, ctx=ctx)
+        return a, a is None and bool(self.ignore.match(uri, ctx=ctx))
+
+    def parentproxy(self, uri, host, command, ip, level=1, size=None, ctx=None):
         '''
             decide which parentproxy to use.
             url:  'www.google.com:443'
@@ -162,12 +198,18 @@ class get_proxy(object):
                    2 -- encrypt all: proxy if local_rule or not https, direct if ip in region or override, proxy if gfwlist
                    3 -- chnroute:    proxy if local_rule, direct if ip in region or override, proxy if all
                    4 -- global:      proxy if not local
+            ip:   ip_address, or resolver.lazy_ip, resolved only if needed
+            size: expected transfer size in bytes, None if unknown
+            ctx:  request_context of uri, parsed here if not given
         '''
         host, port = host
 
-        ifgfwed = self.ifgfwed(uri, host, port, ip, level)
+        ifgfwed = self.ifgfwed(uri, host, port, ip, level, ctx)
+        lazy = callable(ip)
 
         if ifgfwed is False:
+            if lazy:
+                ip = ip()
             if ip and ip.is_private:
                 return [self.conf.parentlist.local or self.conf.parentlist.direct]
             return [self.conf.parentlist.direct]
@@ -177,14 +219,20 @@ class get_proxy(object):
             parentlist.extend(parentlist[1:] if not ifgfwed else parentlist)
             parentlist = parentlist[:self.conf.maxretry]
 
-        location = ip_to_country_code(ip) or u'None'
-
-        def priority(parent):
-            return parent.priority(command, host, location)
-
-        if len(parentlist) > 1:
-            random.shuffle(parentlist)
-            parentlist = sorted(parentlist, key=priority)
+        # location of host adjusts priority, but not worth a dns query
+        if lazy:
+            ip = ip() if ip.resolved else None
+        location = (ip_to_country_code(ip) if ip else None) or u'None'
+
+        parentlist = self.scorer.sort(parentlist, command, host, location, size)
+        # at max_conn, try them after the others; circuit breaker open, try them last
+        allowed = [parent.breaker.available() for parent in parentlist]
+        full = [parent.full() for parent in parentlist]
+        parentlist = [p for p, a, f in zip(parentlist, allowed, full) if a and not f] +\
+            [p for p, a, f in zip(parentlist, allowed, full) if a and f] +\
+            [p for p, a in zip(parentlist, allowed) if not a]
+        if self.sticky and len(parentlist) > 1:
+            parentlist = self.stick(parentlist, command, host, location, size)
 
         if ifgfwed:
             if not parentlist:
@@ -200,6 +248,47 @@ class get_proxy(object):
             parentlist = parentlist[:self.conf.maxretry]
         return parentlist
 
+    def stick(self, parentlist, command, host, location, size=None):
+        '''
+        move the parent host is pinned to to the front,
+        if it is healthy and its score is within sticky_margin of the best one.
+        '''
+        # one ring over all configured parents, rebuilt only when they change.
+        # GET and CONNECT have different parent sets, ineligible ones are skipped below.
+        names = tuple(sorted(self.conf.parentlist.dict))
+        if self._ring.nodes != names:
+            self._ring = hash_ring(names)
+        best = self.scorer.score(parentlist[0], command, host, location, size)
+        candidates = {}
+        for parent in parentlist:
+            if parent.name not in candidates and parent.breaker.state == parent.breaker.CLOSED and not parent.full() and\
+                    self.scorer.score(parent, command, host, location, size) <= best + self.sticky_margin:
+                candidates[parent.name] = parent
+        key = base_domain(host) if self.sticky == 'domain' else host
+        for name in self._ring.iter_nodes(key):
+            if name in candidates:
+                pinned = candidates[name]
+                if pinned is not parentlist[0]:
+                    parentlist.remove(pinned)
+                    parentlist.insert(0, pinned)
+                break
+        return parentlist
+
+    def score_breakdown(self, command='GET', host=None, ip=None, size=None):
+        '''score of each parent proxy, used by api'''
+        location = (ip_to_country_code(ip) or u'None') if ip else u'None'
+        parentlist = self.conf.parentlist.httpsparents() if command == 'CONNECT' else self.conf.parentlist.httpparents()
+        result = []
+        for parent in parentlist:
+            breakdown = self.scorer.breakdown(parent, command, host, location, size)
+            result.append({'name': parent.name,
+                           'score': sum(breakdown.values()),
+                           'breakdown': breakdown,
+                           'stats': parent.stats.breakdown(),
+                           'breaker': parent.breaker.state,
+                           })
+        return sorted(result, key=lambda item: item['score'])
+
     def notify(self, command, url, requesthost, success, failed_parents, current_parent, time=0):
         self.logger.debug('notify: %s %s %s, failed_parents: %r, final: %s' % (command, url, 'Success' if success else 'Failed', failed_parents, current_parent or 'None'))
         failed_parents = [k for k in failed_parents if 'pooled' not in k]
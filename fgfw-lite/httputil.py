@@ -3,16 +3,17 @@
 #
 import sys
 import io
-import itertools
+import time
 import logging
-from threading import RLock, Timer
-from collections import defaultdict, deque
+from threading import Timer
+from collections import defaultdict, OrderedDict
 try:
     from http.client import HTTPMessage
     import email
 except ImportError:
     from httplib import HTTPMessage
-from util import is_connection_dropped
+from util import is_connection_dropped, stat_lock
+import metrics
 
 
 def read_reaponse_line(fp):
@@ -43,6 +44,66 @@ def read_headers(fp):
     return header_data, headers
 
 
+# RFC 7230 section 6.1. Transfer-Encoding and Upgrade are hop-by-hop too,
+# but passed through: chunked body is forwarded as is, websocket is tunneled.
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'proxy-authenticate')
+
+
+def connection_tokens(headers, names=('Connection',)):
+    '''lowercase tokens of Connection header(s)'''
+    tokens = set()
+    for name in names:
+        for token in (headers.get(name) or '').split(','):
+            if token.strip():
+                tokens.add(token.strip().lower())
+    return tokens
+
+
+def keep_alive(version, headers, names=('Connection',)):
+    '''if connection persists after this message, RFC 7230 section 6.3'''
+    tokens = connection_tokens(headers, names)
+    if 'close' in tokens:
+        return False
+    if version >= b'HTTP/1.1':
+        return True
+    # keep_alive: sent by old versions of fwlite
+    return 'keep-alive' in tokens or 'keep_alive' in tokens
+
+
+def hop_by_hop(headers, keep=()):
+    '''names of hop-by-hop headers, and headers listed in Connection, lowercase'''
+    names = set(HOP_BY_HOP) | connection_tokens(headers)
+    names.discard('close')
+    names.discard('keep_alive')
+    return names - set(k.lower() for k in keep)
+
+
+def remove_hop_by_hop(headers, keep=()):
+    for name in hop_by_hop(headers, keep):
+        if name in headers:
+            del headers[name]
+
+
+def filter_header_data(header_data, names, extra=b''):
+    '''remove headers in names (lowercase) from raw header data, add extra lines at the end'''
+    lines = header_data.splitlines(True)
+    result = []
+    skip = False
+    for line in lines[:-1]:
+        if line[:1] in (b' ', b'\t'):
+            # folded continuation of the last header
+            if not skip:
+                result.append(line)
+            continue
+        skip = line.partition(b':')[0].strip().lower().decode('latin1') in names
+        if not skip:
+            result.append(line)
+    result.append(extra)
+    # empty line
+    result.extend(lines[-1:])
+    return b''.join(result)
+
+
 def parse_headers(data):
     if sys.version_info > (3, 0):
         return email.parser.Parser(_class=HTTPMessage).parsestr(data.decode('iso-8859-1'))
@@ -52,13 +113,23 @@ def parse_headers(data):
 
 
 class httpconn_pool(object):
-    def __init__(self):
-        self.POOL = defaultdict(deque)  # {upstream_name: [(soc, ppname), ...]}
-        self.socs = {}  # keep track of sock info
-        self.timerwheel = [set() for _ in range(10)]  # a list of socket object
-        self.timerwheel_iter = itertools.cycle(range(10))
-        self.timerwheel_index = next(self.timerwheel_iter)
-        self.lock = RLock()
+    '''
+    idle upstream connections, keyed by upstream name.
+
+    get / put / remove are O(1): every upstream is an OrderedDict of sockets, most recently
+    used last, and one OrderedDict of all sockets keeps global LRU order for eviction and
+    idle expiry. Liveness checks (select) are done without holding the lock.
+    '''
+    IDLE_TIMEOUT = 300  # seconds since put
+    MAX_PER_UPSTREAM = 16
+    MAX_SIZE = 256
+    INTERVAL = 30
+
+    def __init__(self, name='http'):
+        self.name = name  # counted as pool.<name>.hit / miss / evict / stale / expire
+        self.POOL = defaultdict(OrderedDict)  # {upstream_name: {soc: ppname}}
+        self.socs = OrderedDict()  # {soc: (upstream_name, idle_since)}, least recently used first
+        self.lock = stat_lock('pool.%s' % name)
         self.logger = logging.getLogger('httpconn_pool')
         self.logger.setLevel(logging.INFO)
         hdr = logging.StreamHandler()
@@ -67,47 +138,108 @@ class httpconn_pool(object):
         hdr.setFormatter(formatter)
         self.logger.addHandler(hdr)
 
-        Timer(30, self._purge, ()).start()
+        self._sched()
 
     def put(self, upstream_name, soc, ppname):
+        if self.MAX_PER_UPSTREAM <= 0 or self.MAX_SIZE <= 0:
+            # pooling disabled
+            soc.close()
+            return
+        evicted = []
         with self.lock:
-            self.POOL[upstream_name].append((soc, ppname))
-            self.socs[soc] = (self.timerwheel_index, ppname, upstream_name)
-            self.timerwheel[self.timerwheel_index].add(soc)
+            self._remove(soc)
+            # evict first, _remove drops the per-upstream dict once it is empty
+            while len(self.POOL.get(upstream_name, ())) >= self.MAX_PER_UPSTREAM:
+                evicted.append(self._remove(next(iter(self.POOL[upstream_name]))))
+            while len(self.socs) >= self.MAX_SIZE:
+                evicted.append(self._remove(next(iter(self.socs))))
+            self.POOL[upstream_name][soc] = ppname
+            self.socs[soc] = (upstream_name, time.time())
+            self._gauge()
+        for sock in evicted:
+            sock.close()
+        if evicted:
+            metrics.incr('pool.%s.evict' % self.name, len(evicted))
 
     def get(self, upstream_name):
+        while True:
+            with self.lock:
+                lst = self.POOL.get(upstream_name)
+                if not lst:
+                    break
+                sock, pproxy = lst.popitem()
+                idle_since = self.socs.pop(sock)[1]
+                if not lst:
+                    del self.POOL[upstream_name]
+                self._gauge()
+            if time.time() - idle_since > self.IDLE_TIMEOUT:
+                sock.close()
+                metrics.incr('pool.%s.expire' % self.name)
+                continue
+            if is_connection_dropped([sock]):
+                sock.close()
+                metrics.incr('pool.%s.stale' % self.name)
+                continue
+            metrics.incr('pool.%s.hit' % self.name)
+            return (sock, pproxy)
+        metrics.incr('pool.%s.miss' % self.name)
+
+    def remove(self, soc):
         with self.lock:
-            lst = self.POOL.get(upstream_name)
-            while lst:
-                sock, pproxy = lst.popleft()
-                if is_connection_dropped([sock]):
-                    sock.close()
-                    self._remove(sock)
-                    continue
-                self._remove(sock)
-                return (sock, pproxy)
+            self._remove(soc)
+            self._gauge()
 
     def _remove(self, soc):
-        try:
-            twindex, ppn, upsname = self.socs.pop(soc)
-            self.timerwheel[twindex].discard(soc)
-            if (soc, ppn) in self.POOL[upsname]:
-                self.POOL[upsname].remove((soc, ppn))
-        except KeyError:
-            pass
+        '''remove soc from pool, return it. caller holds the lock'''
+        entry = self.socs.pop(soc, None)
+        if entry:
+            lst = self.POOL[entry[0]]
+            del lst[soc]
+            if not lst:
+                del self.POOL[entry[0]]
+        return soc
+
+    def _gauge(self):
+        metrics.gauge('pool.%s.size' % self.name, len(self.socs))
+
+    def __len__(self):
+        return len(self.socs)
 
     def _purge(self):
-        pcount = 0
+        expired = []
+        deadline = time.time() - self.IDLE_TIMEOUT
         with self.lock:
-            for soc in is_connection_dropped(self.socs.keys()):
-                soc.close()
+            # oldest first, stop at the first one still fresh
+            for soc, (_, idle_since) in self.socs.items():
+                if idle_since > deadline:
+                    break
+                expired.append(soc)
+            for soc in expired:
                 self._remove(soc)
-                pcount += 1
-            self.timerwheel_index = next(self.timerwheel_iter)
-            for soc in list(self.timerwheel[self.timerwheel_index]):
-                soc.close()
+            candidates = list(self.socs)
+        dropped = is_connection_dropped(candidates) if candidates else []
+        with self.lock:
+            # may be taken by get() while checking
+            dropped = [soc for soc in dropped if soc in self.socs]
+            for soc in dropped:
                 self._remove(soc)
-                pcount += 1
-        if pcount:
-            self.logger.debug('%d remotesoc purged, %d in connection pool.(%s)' % (pcount, len(self.socs), ', '.join([k[0] if isinstance(k, tuple) else k for k, v in self.POOL.items() if v])))
-        Timer(30, self._purge, ()).start()
+            self._gauge()
+        for soc in expired + dropped:
+            soc.close()
+        if expired:
+            metrics.incr('pool.%s.expire' % self.name, len(expired))
+        if dropped:
+            metrics.incr('pool.%s.stale' % self.name, len(dropped))
+        if expired or dropped:
+            self.logger.debug('%d remotesoc purged, %d in connection pool.(%s)' % (len(expired) + len(dropped), len(self.socs), ', '.join([k[0] if isinstance(k, tuple) else k for k in list(self.POOL)])))
+
+    def _sched(self):
+        timer = Timer(self.INTERVAL, self._tick, ())
+        timer.daemon = True
+        timer.start()
+
+    def _tick(self):
+        try:
+            self._purge()
+        finally:
+            self._sched()
@@ -25,8 +25,7 @@ import hashlib
 import hmac
 import socket
 
-from collections import defaultdict
-from threading import RLock, Thread
+from threading import Thread
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -34,6 +33,8 @@ except ImportError:
 from basesocket import basesocket
 from parent_proxy import ParentProxy
 from httputil import httpconn_pool
+from util import keyed_lock
+from connection import tfo_check
 import encrypt
 from ecc import ECC
 
@@ -55,7 +56,7 @@ CTX = b'hxsocks'
 MAC_LEN = 16
 
 keys = {}
-newkey_lock = defaultdict(RLock)
+newkey_lock = keyed_lock('hxsocks.newkey')
 known_hosts = {}
 
 # load known certs
@@ -66,7 +67,7 @@ for fname in os.listdir('./.hxs_known_hosts'):
         known_hosts[fname[:-5]] = open('./.hxs_known_hosts/' + fname, 'rb').read()
 
 
-POOL = httpconn_pool()
+POOL = httpconn_pool('hxsocks')
 
 
 def hxssocket(hxsServer, ctimeout=4, parentproxy=None):
@@ -103,14 +104,16 @@ class _hxssocket(basesocket):
         self.writeable = 0
         self.pooled = 0
 
-    def connect(self, address):
+    def connect(self, address, deadline=None):
         self._address = address
-        self.getKey()
+        self.getKey(deadline)
         if self._sock is None:
             from connection import create_connection
             host, port = self.hxsServer.hostname, self.hxsServer.port
-            self._sock = create_connection((host, port), self.timeout, parentproxy=self.parentproxy, tunnel=True)
+            self._sock = create_connection((host, port), self.timeout, parentproxy=self.parentproxy, tunnel=True, tfo=self.hxsServer.tfo, uplink=self.hxsServer.uplink, deadline=deadline)
             self.pskcipher = encrypt.Encryptor(self.PSK, self.method)
+        if deadline:
+            deadline.apply(self._sock)
         logger.debug('hxsocks send connect request')
         padding_len = random.randint(64, 255)
         pt = struct.pack('>I', int(time.time())) + chr(len(self._address[0])) + self._address[0] + struct.pack('>H', self._address[1]) + b'\x00' * padding_len
@@ -126,6 +129,7 @@ class _hxssocket(basesocket):
         resp_len = struct.unpack('>H', resp_len)[0]
 
         resp = self.pskcipher.decrypt(fp.read(resp_len))
+        tfo_check(self._sock)
 
         d = ord(resp[0]) if resp else None
         if d == 0:
@@ -140,7 +144,7 @@ class _hxssocket(basesocket):
                 del keys[self.serverid]
             raise IOError(0, 'hxsocks Error: invalid shared key. code %d' % d)
 
-    def getKey(self):
+    def getKey(self, deadline=None):
         with newkey_lock[self.serverid]:
             if self.serverid not in keys:
                 for _ in range(2):
@@ -149,8 +153,10 @@ class _hxssocket(basesocket):
                     if self._sock is None:
                         logger.debug('hxsocks connect')
                         from connection import create_connection
-                        self._sock = create_connection((host, port), self.timeout, parentproxy=self.parentproxy, tunnel=True)
+                        self._sock = create_connection((host, port), self.timeout, parentproxy=self.parentproxy, tunnel=True, tfo=self.hxsServer.tfo, uplink=self.hxsServer.uplink, deadline=deadline)
                         self.pskcipher = encrypt.Encryptor(self.PSK, self.method)
+                    if deadline:
+                        deadline.apply(self._sock)
                     acipher = ECC(self.pskcipher.key_len)
                     pubk = acipher.get_pub_key()
                     logger.debug('hxsocks send key exchange request')
@@ -165,6 +171,7 @@ class _hxssocket(basesocket):
                     resp_len = self.pskcipher.decrypt(fp.read(resp_len))
                     resp_len = struct.unpack('>H', resp_len)[0]
                     data = self.pskcipher.decrypt(fp.read(resp_len))
+                    tfo_check(self._sock)
 
                     data = io.BytesIO(data)
 
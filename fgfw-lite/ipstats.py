@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding:utf-8
+#
+# ipstats.py  connect latency and failures of destination ip addresses
+#
+# used to try the best address of a host first, instead of a random one.
+
+import time
+import random
+from threading import RLock
+from collections import OrderedDict
+
+FAILURE_PENALTY = 5  # seconds, counted as connect time of a failed attempt
+FAILURE_DECAY = 300  # seconds, a failure counts half after this
+EXPLORE = 0.05  # chance of trying another address first
+
+
+class ip_stats(object):
+    ALPHA = 0.3  # weight of the last sample
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.table = OrderedDict()  # {addr: [EWMA of connect time, failures, last_failure]}
+        self.lock = RLock()
+
+    def _get(self, addr):
+        item = self.table.pop(addr, None)
+        if item is None:
+            item = [None, 0, 0]
+            if len(self.table) >= self.size:
+                self.table.popitem(last=False)
+        self.table[addr] = item
+        return item
+
+    def log(self, addr, rtime):
+        with self.lock:
+            item = self._get(addr)
+            item[0] = rtime if item[0] is None else (1 - self.ALPHA) * item[0] + self.ALPHA * rtime
+
+    def failed(self, addr):
+        with self.lock:
+            item = self._get(addr)
+            item[1] = self._failures(item) + 1
+            item[2] = time.time()
+
+    def _failures(self, item):
+        if not item[1]:
+            return 0
+        return item[1] * 0.5 ** ((time.time() - item[2]) / FAILURE_DECAY)
+
+    def score(self, addr, default=0):
+        '''expected connect time in seconds, lower is better. default for unknown addresses'''
+        item = self.table.get(addr)
+        if item is None:
+            return default
+        rtime = default if item[0] is None else item[0]
+        return rtime + self._failures(item) * FAILURE_PENALTY
+
+    def reliable(self, addr):
+        '''connected before, no recent failures'''
+        item = self.table.get(addr)
+        return item is not None and item[0] is not None and self._failures(item) < 0.1
+
+    def order(self, iplist, explore=True):
+        '''
+        iplist: [(family, addr), ...], sorted best first.
+        unknown addresses are scored as the average of known ones, so they get tried.
+        explore: with chance EXPLORE, another address goes first. only where it is connected.
+        '''
+        if len(iplist) < 2:
+            return list(iplist)
+        with self.lock:
+            known = [self.table[addr][0] for _, addr in iplist if addr in self.table and self.table[addr][0] is not None]
+            default = sum(known) / len(known) if known else 0
+            result = list(iplist)
+            # random order among equals
+            random.shuffle(result)
+            result.sort(key=lambda item: self.score(item[1], default))
+        if explore and random.random() < EXPLORE:
+            result.insert(0, result.pop(random.randrange(1, len(result))))
+        return result
+
+    def dump(self):
+        with self.lock:
+            return dict((addr, {'connect_time': None if item[0] is None else round(item[0], 3),
+                                'failures': round(self._failures(item), 2)})
+                        for addr, item in self.table.items())
+
+
+IP_STATS = ip_stats()
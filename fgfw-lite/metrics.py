@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding:utf-8
+#
+# metrics.py  process wide counters and gauges, served at /api/metrics
+
+import time
+from threading import RLock
+from collections import defaultdict
+
+_lock = RLock()
+_counters = defaultdict(int)
+_gauges = {}
+_start = time.time()
+
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+def gauge(name, value):
+    _gauges[name] = value
+
+
+def get(name):
+    return _counters.get(name, 0)
+
+
+def ratio(hit, miss):
+    '''hit / (hit + miss) of two counters'''
+    total = get(hit) + get(miss)
+    return get(hit) / float(total) if total else 0
+
+
+def snapshot():
+    with _lock:
+        result = dict(_counters)
+    result.update(_gauges)
+    for name in list(result):
+        if name.endswith('.hit'):
+            prefix = name[:-4]
+            result[prefix + '.hit_ratio'] = round(ratio(name, prefix + '.miss'), 3)
+    result['uptime'] = time.time() - _start
+    return result
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 # coding:utf-8
 import sys
+import math
 import time
 import traceback
 import socket
+import ssl
 import logging
+from collections import deque
+from threading import RLock, Thread, Condition
 try:
     import urllib.parse as urlparse
     urlquote = urlparse.quote
@@ -17,6 +21,7 @@ except ImportError:
     urlunquote = urllib2.unquote
     from ipaddr import IPAddress as ip_address
 from util import ip_to_country_code
+import metrics
 
 ASIA = ('AE', 'AF', 'AL', 'AZ', 'BD', 'BH', 'BN', 'BT', 'CN', 'CY', 'HK', 'ID',
         'IL', 'IN', 'IQ', 'IR', 'JO', 'JP', 'KH', 'KP', 'KR', 'KW', 'KZ', 'LA',
@@ -48,13 +53,253 @@ class default_0_dict(dict):
         return 0
 
 
+class ParentStats(object):
+    '''
+    rolling statistics of a parent proxy, used by scorer.
+    latency samples are kept for WINDOW seconds, counters decay with HALF_LIFE.
+
+    latency is time to first byte of response. connect (tcp, and tls for https parents)
+    and handshake (until tunnel is ready, via hops included) are kept apart,
+    timeout() of each phase is derived from them.
+    '''
+    WINDOW = 600
+    MAX_SAMPLES = 256
+    HALF_LIFE = 300
+    PHASES = ('connect', 'handshake', 'first_byte')
+    # adaptive timeout: p99 * TIMEOUT_FACTOR, in [TIMEOUT_FLOOR, TIMEOUT_CEILING]
+    ADAPTIVE_TIMEOUT = False
+    TIMEOUT_FACTOR = 3
+    TIMEOUT_FLOOR = {'connect': 1, 'handshake': 1, 'first_byte': 4}
+    TIMEOUT_CEILING = 20
+    TIMEOUT_MIN_SAMPLES = 20
+
+    def __init__(self):
+        self.lock = RLock()
+        self.slot = Condition(self.lock)  # notified when inflight drops
+        self.latency = deque(maxlen=self.MAX_SAMPLES)  # [(timestamp, seconds), ...]
+        self.phase_latency = {'connect': deque(maxlen=self.MAX_SAMPLES),
+                              'handshake': deque(maxlen=self.MAX_SAMPLES),
+                              'first_byte': self.latency}
+        self.throughput = 0  # EWMA of bytes/s
+        self.success = 0
+        self.failure = 0
+        self.selected = 0
+        self.inflight = 0
+        self.total_bytes = 0
+        self.last_update = time.time()
+        self.last_failure = 0
+
+    def _decay(self):
+        now = time.time()
+        factor = 0.5 ** ((now - self.last_update) / self.HALF_LIFE)
+        self.success *= factor
+        self.failure *= factor
+        self.selected *= factor
+        self.last_update = now
+
+    def begin(self, limit=0, timeout=0):
+        '''
+        count a new connection. if limit is set and reached, wait up to timeout seconds
+        for one to end, return False if still full.
+        '''
+        with self.lock:
+            if limit and self.inflight >= limit:
+                deadline = time.time() + timeout
+                while self.inflight >= limit and time.time() < deadline:
+                    self.slot.wait(deadline - time.time())
+                if self.inflight >= limit:
+                    return False
+            self._decay()
+            self.inflight += 1
+            self.selected += 1
+            return True
+
+    def end(self, success, nbytes=0, duration=0):
+        '''success: True, False, or None if outcome unknown'''
+        with self.lock:
+            self._decay()
+            self.inflight = max(self.inflight - 1, 0)
+            self.slot.notify()
+            if success is True:
+                self.success += 1
+            elif success is False:
+                self.failure += 1
+                self.last_failure = time.time()
+            self.total_bytes += nbytes
+            # short transfers tell nothing about bandwidth
+            if nbytes > 65536 and duration > 0.1:
+                rate = nbytes / duration
+                self.throughput = 0.7 * self.throughput + 0.3 * rate if self.throughput else rate
+
+    def log_latency(self, rtime, phase='first_byte'):
+        with self.lock:
+            self.phase_latency[phase].append((time.time(), rtime))
+
+    def _samples(self, phase):
+        with self.lock:
+            ts = time.time() - self.WINDOW
+            return sorted(v for t, v in self.phase_latency[phase] if t > ts)
+
+    def percentile(self, p, phase='first_byte'):
+        lst = self._samples(phase)
+        if not lst:
+            return 0
+        return lst[max(int(math.ceil(p / 100.0 * len(lst))) - 1, 0)]
+
+    def timeout(self, phase, default):
+        '''timeout for phase, default if disabled or not enough samples'''
+        if not self.ADAPTIVE_TIMEOUT:
+            return default
+        lst = self._samples(phase)
+        if len(lst) < self.TIMEOUT_MIN_SAMPLES:
+            return default
+        p99 = lst[max(int(math.ceil(0.99 * len(lst))) - 1, 0)]
+        return min(max(p99 * self.TIMEOUT_FACTOR, self.TIMEOUT_FLOOR[phase]), self.TIMEOUT_CEILING)
+
+    @property
+    def failure_ratio(self):
+        with self.lock:
+            self._decay()
+            total = self.success + self.failure
+            return self.failure / total if total > 0.01 else 0
+
+    def dump(self):
+        with self.lock:
+            return {'latency': [(round(t, 1), round(v, 3)) for t, v in self.latency],
+                    'connect': [(round(t, 1), round(v, 3)) for t, v in self.phase_latency['connect']],
+                    'handshake': [(round(t, 1), round(v, 3)) for t, v in self.phase_latency['handshake']],
+                    'throughput': round(self.throughput),
+                    'success': round(self.success, 3),
+                    'failure': round(self.failure, 3),
+                    'selected': round(self.selected, 3),
+                    'last_update': round(self.last_update, 1),
+                    'last_failure': round(self.last_failure, 1),
+                    }
+
+    def restore(self, data):
+        '''replace samples and counters with saved ones'''
+        with self.lock:
+            self.latency.clear()
+            self.latency.extend(tuple(item) for item in data.get('latency', []))
+            for phase in ('connect', 'handshake'):
+                self.phase_latency[phase].clear()
+                self.phase_latency[phase].extend(tuple(item) for item in data.get(phase, []))
+            for key in ('throughput', 'success', 'failure', 'selected', 'last_update', 'last_failure'):
+                if key in data:
+                    setattr(self, key, data[key])
+
+    def breakdown(self):
+        return {'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'throughput': self.throughput,
+                'failure_ratio': self.failure_ratio,
+                'inflight': self.inflight,
+                'selected': self.selected,
+                'total_bytes': self.total_bytes,
+                }
+
+
+class CircuitBreaker(object):
+    '''
+    closed: requests pass.
+    open: opened after THRESHOLD consecutive connect failures, parent moved to the end of list.
+    half_open: after cooldown, a health probe is started, and one trial request is allowed.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    THRESHOLD = 3
+    COOLDOWN = 30
+    MAX_COOLDOWN = 300
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.lock = RLock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.cooldown = self.COOLDOWN
+        self.opened = 0
+        self.trial = False
+        self.probing = False
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.info('%s circuit breaker %s -> %s' % (self.parent.name, self.state, state))
+            self.state = state
+            metrics.incr('breaker.%s' % state)
+            metrics.incr('breaker.%s.%s' % (self.parent.name, state))
+
+    def available(self):
+        '''if a request may go through this parent, read only, for ranking'''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.time() - self.opened >= self.cooldown
+            return not self.trial
+
+    def allow(self):
+        '''
+        if a request should go through this parent, called when it is selected.
+        takes the half open trial, and starts a probe after cooldown.
+        '''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened < self.cooldown:
+                    return False
+                self._set_state(self.HALF_OPEN)
+                self.trial = False
+                self.start_probe()
+            # half open, allow one trial request
+            if not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.COOLDOWN
+            self._set_state(self.CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.cooldown = min(self.cooldown * 2, self.MAX_COOLDOWN)
+                self._open()
+            elif self.state == self.CLOSED and self.failures >= self.THRESHOLD:
+                self._open()
+
+    def _open(self):
+        self.opened = time.time()
+        self._set_state(self.OPEN)
+
+    def start_probe(self):
+        if self.probing:
+            return
+        self.probing = True
+        t = Thread(target=self._probe)
+        t.daemon = True
+        t.start()
+
+    def _probe(self):
+        try:
+            if self.parent.probe():
+                self.success()
+            else:
+                self.failure()
+        finally:
+            self.probing = False
+
+
 class ParentProxy(object):
     via = None
     DEFAULT_TIMEOUT = 8
-    avg_resp_time = 0
-    avg_resp_time_ts = 0
-    avg_resp_time_by_host = default_0_dict()
-    avg_resp_time_by_host_ts = default_0_dict()
+    QUEUE_TIMEOUT = 5  # wait for a free slot of the last parent at its max_conn
 
     def __init__(self, name, proxy):
         '''
@@ -82,8 +327,28 @@ class ParentProxy(object):
         self.httppriority = int(httppriority)
         self.httpspriority = int(httpspriority)
         self.timeout = int(timeout)
-        self.country_code = urlparse.parse_qs(self.parse.query).get('location', [''])[0] or None
+        query = urlparse.parse_qs(self.parse.query)
+        self.country_code = query.get('location', [''])[0] or None
+        # socks5: send greeting, auth and connect request at once, disabled if server rejects it
+        self.socks5_pipeline = query.get('pipeline', [''])[0] == '1'
+        # https: ?verify=1 checks certificate and hostname, ?cafile=path to trust a private ca
+        self.tls_verify = query.get('verify', [''])[0] == '1'
+        self.tls_cafile = query.get('cafile', [''])[0] or None
+        self._ssl_context = None
+        # ?tfo=1: TCP Fast Open to this parent, for the direct parent see fgfwproxy/tfo
+        self.tfo = query.get('tfo', [''])[0] == '1'
+        # ?uplink=wan1|wan2: uplink names or source addresses for connections to this parent, default all
+        self.uplink = [x for x in query.get('uplink', [''])[0].split('|') if x]
+        # ?max_conn=N: at most N connections in flight, more go to the next parent. 0 for no limit
+        self.max_conn = int(query.get('max_conn', ['0'])[0] or 0)
+        self.tls_session = None  # last session, for resumption (python 3.6+)
         self.last_ckeck = 0
+        self.avg_resp_time = 0
+        self.avg_resp_time_ts = 0
+        self.avg_resp_time_by_host = default_0_dict()
+        self.avg_resp_time_by_host_ts = default_0_dict()
+        self.stats = ParentStats()
+        self.breaker = CircuitBreaker(self)
         if self.parse.scheme.lower() == 'sni':
             self.httppriority = -1
 
@@ -121,10 +386,13 @@ class ParentProxy(object):
         finally:
             return self.country_code
 
-    def priority(self, method=None, host=None, country_code=None):
-        if any([host, country_code]) and not all([host, country_code]):
-            raise ValueError('host and country_code should be provided together.')
-        result = self.httpspriority if method is 'CONNECT' else self.httppriority
+    def full(self):
+        '''max_conn connections in flight'''
+        return bool(self.max_conn) and self.stats.inflight >= self.max_conn
+
+    def base_priority(self, method=None, country_code=None):
+        '''static priority, adjusted by location'''
+        result = self.httpspriority if method == 'CONNECT' else self.httppriority
         if country_code == self.get_location():
             result -= 2
         else:
@@ -132,17 +400,32 @@ class ParentProxy(object):
                 if self.get_location() in continent and country_code in continent:
                     result -= 1
                     break
+        return result
+
+    def priority(self, method=None, host=None, country_code=None):
+        if any([host, country_code]) and not all([host, country_code]):
+            raise ValueError('host and country_code should be provided together.')
+        result = self.base_priority(method, country_code)
         score = self.get_avg_resp_time() + self.get_avg_resp_time(host)
         result += score * 5
         logger.debug('proxy %s to %s response time penalty is %.3f' % (self.name, host, score * 5))
         return result
 
-    def log(self, host, rtime):
+    def log(self, host, rtime, failed=False):
         self.avg_resp_time = 0.87 * self.get_avg_resp_time() + (1 - 0.87) * rtime
         self.avg_resp_time_by_host[host] = 0.87 * self.get_avg_resp_time(host) + (1 - 0.87) * rtime
         self.avg_resp_time_ts = self.avg_resp_time_by_host_ts[host] = time.time()
+        if not failed:
+            self.stats.log_latency(rtime)
         logger.debug('%s to %s: %.3fs %.3fs' % (self.name, host, rtime, self.avg_resp_time))
 
+    def adaptive_timeout(self, phase, default):
+        '''timeout of phase from observed latency, exported as metrics gauge'''
+        result = self.stats.timeout(phase, default)
+        if result is not None:
+            metrics.gauge('timeout.%s.%s' % (self.name, phase), round(result, 3))
+        return result
+
     def get_avg_resp_time(self, host=None):
         if host is None:
             if time.time() - self.avg_resp_time_ts > 360:
@@ -154,6 +437,22 @@ class ParentProxy(object):
             self.avg_resp_time_by_host_ts[host] = time.time()
         return self.avg_resp_time_by_host[host] or self.avg_resp_time
 
+    def probe(self):
+        '''lightweight health check: connect to parent proxy server'''
+        if not self.proxy:
+            return True
+        from connection import create_connection
+        default_port = {'http': 80, 'https': 443, 'sni': 443, 'socks5': 1080}
+        try:
+            soc = create_connection((self.hostname, self.port or default_port.get(self.scheme, 80)), self.timeout, parentproxy=self.get_via(), tunnel=True)
+            soc.close()
+            metrics.incr('breaker.probe_success')
+            return True
+        except Exception as e:
+            logger.debug('probe %s failed: %r' % (self.name, e))
+            metrics.incr('breaker.probe_failure')
+            return False
+
     @property
     def scheme(self):
         return self.parse.scheme
@@ -178,6 +477,20 @@ class ParentProxy(object):
     def set_via(cls, proxy):
         cls.via = proxy
 
+    def ssl_context(self):
+        '''created once, so the session cache and loaded certificates are reused'''
+        if self._ssl_context is None:
+            if self.tls_verify:
+                context = ssl.create_default_context(cafile=self.tls_cafile)
+            else:
+                context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23))
+                context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+                if self.tls_cafile:
+                    context.load_verify_locations(self.tls_cafile)
+                    context.verify_mode = ssl.CERT_REQUIRED
+            self._ssl_context = context
+        return self._ssl_context
+
     def get_via(self):
         if self.via == self:
             return None
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # coding: UTF-8
 import re
+import heapq
 import logging
+import itertools
+from collections import defaultdict
 try:
     import urllib.parse as urlparse
     urlquote = urlparse.quote
@@ -12,6 +15,7 @@ except ImportError:
     urlunquote = urllib2.unquote
 
 from apfilter import ap_rule, ap_filter
+from util import request_context
 try:
     from _manager import redirector as uredirector
 except ImportError:
@@ -32,16 +36,26 @@ class redirector(object):
         self._bad302 = ap_filter()
         self.adblock = ap_filter()
         self.redirlst = []
+        # redirect rules indexed by host / domain: {host: [(seq, ap_rule, dest), ...]}
+        # rules without a fixed host go to redir_global. seq keeps the order of redirlst.
+        self.redir_index = defaultdict(list)
+        self.redir_global = []
+        self._seq = itertools.count()
 
     def redirect(self, hdlr):
-        searchword = re.match(r'^http://([\w-]+)/$', hdlr.path)
+        ctx = getattr(hdlr, 'ctx', None) or request_context.from_url(hdlr.path)
+        searchword = ctx.scheme == 'http' and ctx.path == '/' and len(ctx.labels) == 1 and re.match(r'^http://([\w-]+)/$', hdlr.path)
         if searchword:
             q = searchword.group(1)
             if 'xn--' in q:
                 q = q.encode().decode('idna')
             self.logger.debug('Match redirect rule addressbar-search')
             return 'https://www.google.com/search?q=%s&ie=utf-8&oe=utf-8' % urlquote(q.encode('utf-8'))
-        for rule, result in self.redirlst:
+        if self.redir_index:
+            rules = heapq.merge(self.redir_global, *[self.redir_index[d] for d in ctx.suffixes if d in self.redir_index])
+        else:
+            rules = self.redir_global
+        for _, rule, result in rules:
             if rule.match(hdlr.path):
                 self.logger.debug('Match redirect rule {}, {}'.format(rule.rule, result))
                 if rule.override:
@@ -51,10 +65,22 @@ class redirector(object):
                 if result.startswith('/') and result.endswith('/'):
                     return rule._regex.sub(result[1:-1], hdlr.path)
                 return result
-        if self.adblock.match(hdlr.path):
+        if self.adblock.match(hdlr.path, ctx=ctx):
             return 'adblock'
         return uredirector(hdlr)
 
+    @staticmethod
+    def rule_host(rule):
+        '''
+        host or domain a rule is bound to, None if not bound.
+        the host part must end with a separator, or '|http://example' would match example.com.cn too.
+        '''
+        if rule.startswith('@@'):
+            rule = rule[2:]
+        m = re.match(r'^(?:\|\||\|https?://)([^/:^*|?]+)[/:^|]', rule)
+        if m:
+            return m.group(1).lower()
+
     def bad302(self, uri):
         return self._bad302.match(uri)
 
@@ -62,7 +88,7 @@ class redirector(object):
         if pp is None:
             pp = self.conf.PARENT_PROXY
         try:
-            if rule in [a.rule for a, b in self.redirlst]:
+            if any(a.rule == rule for a, b in self.redirlst):
                 self.logger.warning('multiple redirector rule! %s' % rule)
                 return
             if dest.lower() == 'auto':
@@ -71,6 +97,20 @@ class redirector(object):
                 return self._bad302.add(rule)
             if dest.lower() == 'adblock':
                 return self.adblock.add(rule)
-            self.redirlst.append((ap_rule(rule), dest))
+            o = ap_rule(rule)
+            self.redirlst.append((o, dest))
+            host = self.rule_host(rule)
+            lst = self.redir_index[host] if host else self.redir_global
+            lst.append((next(self._seq), o, dest))
         except ValueError as e:
             self.logger.debug('create autoproxy rule failed: %s' % e)
+
+    def remove_redirect(self, index):
+        '''remove redirlst[index] and its index entry, return (ap_rule, dest)'''
+        o, dest = self.redirlst.pop(index)
+        host = self.rule_host(o.rule)
+        lst = self.redir_index[host] if host else self.redir_global
+        lst[:] = [item for item in lst if item[1] is not o]
+        if host and not lst:
+            del self.redir_index[host]
+        return o, dest
@@ -8,9 +8,8 @@ import select
 import traceback
 import logging
 import time
-import itertools
-from threading import Event, Timer, RLock, Thread
-from collections import defaultdict
+from threading import Event, RLock, Thread
+from collections import defaultdict, OrderedDict
 
 try:
     from ipaddr import IPAddress as ip_address
@@ -18,6 +17,9 @@ except ImportError:
     from ipaddress import ip_address
 
 from connection import create_connection
+from ipstats import IP_STATS
+from util import stat_lock, keyed_lock
+import metrics
 
 
 logger = logging.getLogger('resolver')
@@ -29,69 +31,109 @@ hdr.setFormatter(formatter)
 logger.addHandler(hdr)
 
 
-NUM_CACHE = 12
-NUM_BAD_CACHE = 2
-CLEAN_INTV = 10
-
-
 class DNS_Cache(object):
+    '''
+    dns results keyed on (name, qtype, upstream), dropped past MAX_SIZE in insertion order,
+    except entries hit since their last pass get a second chance (approximate LRU).
+    hits don't take the lock, they only set the touched flag of the entry. expired entries
+    are dropped when looked up.
+
+    a DNSRecord lives for the minimum TTL of its answers, a negative answer (NXDOMAIN,
+    or no answer) for the SOA TTL / minimum in authority section (RFC 2308 section 5).
+    both are kept in [MIN_TTL, MAX_TTL]. errors, and negative answers without SOA,
+    are kept FAIL_TTL, results of system getaddrinfo DEFAULT_TTL.
+    '''
+    MIN_TTL = 30
+    MAX_TTL = 3600
+    FAIL_TTL = 10
+    DEFAULT_TTL = 120
+    MAX_SIZE = 4096
+
     def __init__(self):
-        self._cache = [{} for _ in range(NUM_CACHE)]
-        self._bad_cache = [{} for _ in range(NUM_BAD_CACHE)]
-        self._cache_iter = itertools.cycle(range(NUM_CACHE))
-        self._cache_id = next(self._cache_iter)
-        self._bad_cache_iter = itertools.cycle(range(NUM_BAD_CACHE))
-        self._bad_cache_id = next(self._bad_cache_iter)
-        self._lock = RLock()
-        Timer(CLEAN_INTV, self._sched_clean, ()).start()
+        self._cache = OrderedDict()  # {(name, qtype, upstream): [expire, result, touched]}
+        self._lock = stat_lock('dns_cache')
 
-    def cache(self, host, qtype, result):
-        with self._lock:
-            if not result or isinstance(result, Exception):
-                self._bad_cache[self._bad_cache_id][(host, qtype)] = result
-            else:
-                self._cache[self._cache_id][(host, qtype)] = result
+    def ttl(self, result):
+        if isinstance(result, Exception):
+            return self.FAIL_TTL
+        if not isinstance(result, dnslib.DNSRecord):
+            return min(max(self.DEFAULT_TTL, self.MIN_TTL), self.MAX_TTL)
+        if result.header.rcode == dnslib.RCODE.NOERROR and result.rr:
+            ttl = min(rr.ttl for rr in result.rr)
+        elif result.header.rcode in (dnslib.RCODE.NOERROR, dnslib.RCODE.NXDOMAIN):
+            soa = [rr for rr in result.auth if rr.rtype == dnslib.QTYPE.SOA]
+            if not soa:
+                return self.FAIL_TTL
+            ttl = min(soa[0].ttl, soa[0].rdata.times[4])
+        else:
+            # SERVFAIL, REFUSED...
+            return self.FAIL_TTL
+        return min(max(ttl, self.MIN_TTL), self.MAX_TTL)
 
-    def query(self, host, qtype):
+    def cache(self, name, qtype, upstream, result):
+        if not result:
+            return
+        key = (name.lower(), qtype, upstream)
+        expire = time.time() + self.ttl(result)
         with self._lock:
-            for v in self._bad_cache:
-                if (host, qtype) in v:
-                    logger.debug('dns cache hit: bad result, {} {}'.format(host, qtype))
-                    return v[(host, qtype)]
-            for v in self._cache:
-                if (host, qtype) in v:
-                    logger.debug('dns cache hit: good result, {} {}'.format(host, qtype))
-                    return v[(host, qtype)]
-            logger.debug('dns cache hit: good result, {} {}'.format(host, qtype))
+            self._cache.pop(key, None)
+            self._cache[key] = [expire, result, False]
+            evicted = 0
+            while len(self._cache) > self.MAX_SIZE:
+                k, entry = self._cache.popitem(last=False)
+                if entry[2]:
+                    # second chance
+                    entry[2] = False
+                    self._cache[k] = entry
+                    continue
+                evicted += 1
+            size = len(self._cache)
+        if evicted:
+            metrics.incr('dns.cache.evict', evicted)
+        metrics.gauge('dns.cache.size', size)
+
+    def query(self, name, qtype, upstream):
+        key = (name.lower(), qtype, upstream)
+        entry = self._cache.get(key)
+        if entry is None:
+            metrics.incr('dns.cache.miss')
+            logger.debug('dns cache miss, {} {}'.format(name, qtype))
+            return
+        if entry[0] <= time.time():
+            # drop it, under the lock as OrderedDict is not safe to change concurrently
+            with self._lock:
+                if self._cache.get(key) is entry:
+                    del self._cache[key]
+            metrics.incr('dns.cache.expire')
+            metrics.incr('dns.cache.miss')
+            return
+        entry[2] = True
+        result = entry[1]
+        metrics.incr('dns.cache.hit')
+        if isinstance(result, Exception) or (isinstance(result, dnslib.DNSRecord) and not result.rr):
+            metrics.incr('dns.cache.negative')
+        logger.debug('dns cache hit, {} {}'.format(name, qtype))
+        return result
 
     def clean(self):
         with self._lock:
-            self._cache = [{} for _ in range(NUM_CACHE)]
-            self._bad_cache = [{} for _ in range(NUM_BAD_CACHE)]
-
-    def _sched_clean(self):
-        with self._lock:
-            self._cache_id = next(self._cache_iter)
-            self._bad_cache_id = next(self._bad_cache_iter)
-            self._cache[self._cache_id] = {}
-            self._bad_cache[self._bad_cache_id] = {}
-        Timer(CLEAN_INTV, self._sched_clean, ()).start()
+            self._cache = OrderedDict()
 
 dns_cache = DNS_Cache()
 
 
 def getaddrinfo(host, port, family=0, socktype=0, proto=0, flags=0):
-    result = dns_cache.query(host, (port, family, socktype, proto, flags))
+    result = dns_cache.query(host, (port, family, socktype, proto, flags), 'system')
     if result:
         if isinstance(result, Exception):
             raise result
         return result
     try:
         result = socket.getaddrinfo(host, port, family, socktype, proto, flags)
-        dns_cache.cache(host, (port, family, socktype, proto, flags), result)
+        dns_cache.cache(host, (port, family, socktype, proto, flags), 'system', result)
         return result
     except Exception as e:
-        dns_cache.cache(host, (port, family, socktype, proto, flags), e)
+        dns_cache.cache(host, (port, family, socktype, proto, flags), 'system', e)
         raise e
 
 
@@ -160,22 +202,22 @@ def tcp_dns_record(host, qtype, server, proxy):
 
 class BaseResolver(object):
     def __init__(self, dnsserver):
-        self.hostlock = defaultdict(RLock)
+        self.hostlock = keyed_lock('resolver.host')
         self.dnsserver = tuple(dnsserver)
 
     def record(self, host, qtype):
         with self.hostlock[(host, qtype)]:
-            result = dns_cache.query(host, (qtype, self.dnsserver))
+            result = dns_cache.query(host, qtype, self.dnsserver)
             if result:
                 if isinstance(result, Exception):
                     raise result
                 return result
             try:
                 result = self._record(host, qtype)
-                dns_cache.cache(host, (host, (qtype, self.dnsserver)), result)
+                dns_cache.cache(host, qtype, self.dnsserver, result)
                 return result
             except Exception as e:
-                dns_cache.cache(host, (host, (qtype, self.dnsserver)), e)
+                dns_cache.cache(host, qtype, self.dnsserver, e)
                 raise e
 
     def _record(self, host, qtype):
@@ -206,6 +248,59 @@ class BaseResolver(object):
             except Exception:
                 return ip_address(u'0.0.0.0')
 
+    def lazy_ip_address(self, host):
+        return lazy_ip(self, host)
+
+
+class lazy_ip(object):
+    '''
+    ip address of host, resolved on first call, or in background after start().
+    call it for the ip_address (0.0.0.0 if failed), iplist for create_connection.
+    literal: host is an ip address or localhost, known without dns.
+    '''
+    def __init__(self, resolver, host):
+        self.resolver = resolver
+        self.host = host
+        self._iplist = None
+        self._lock = RLock()
+        try:
+            ip = ip_address(unicode(host))
+            self._iplist = [(2 if ip._version == 4 else 10, host), ]
+        except Exception:
+            if host == 'localhost':
+                self._iplist = [(2, '127.0.0.1'), ]
+        self.literal = self._iplist is not None
+
+    @property
+    def resolved(self):
+        return self._iplist is not None
+
+    def start(self):
+        if not self.resolved:
+            t = Thread(target=self._resolve)
+            t.daemon = True
+            t.start()
+
+    def _resolve(self):
+        with self._lock:
+            if self._iplist is None:
+                try:
+                    # best address first, explored when connected, in connection._interleave
+                    self._iplist = IP_STATS.order(self.resolver.resolve(self.host, dirty=True), explore=False)
+                except Exception:
+                    self._iplist = []
+        return self._iplist
+
+    @property
+    def iplist(self):
+        return list(self._resolve())
+
+    def __call__(self):
+        iplist = self._resolve()
+        if iplist:
+            return ip_address(unicode(iplist[0][1]))
+        return ip_address(u'0.0.0.0')
+
 
 class MEvent(object):
     def __init__(self):
@@ -236,7 +331,7 @@ class UDP_Resolver(BaseResolver):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.timeout = timeout
         self.event_dict = defaultdict(MEvent)
-        self.hostlock = defaultdict(RLock)
+        self.hostlock = keyed_lock('resolver.host')
         t = Thread(target=self.daemon)
         t.daemon = True
         t.start()
@@ -286,7 +381,7 @@ class R_UDP_Resolver(BaseResolver):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.timeout = timeout
         self.event_dict = defaultdict(MEvent)
-        self.hostlock = defaultdict(RLock)
+        self.hostlock = keyed_lock('resolver.host')
         t = Thread(target=self.daemon)
         t.daemon = True
         t.start()
@@ -338,7 +433,7 @@ class TCP_Resolver(BaseResolver):
     def __init__(self, dnsserver, proxy=None):
         self.dnsserver = tuple(dnsserver)
         self.proxy = proxy
-        self.hostlock = defaultdict(RLock)
+        self.hostlock = keyed_lock('resolver.host')
 
     def _record(self, domain, qtype):
         return tcp_dns_record(domain, qtype, self.dnsserver[0], self.proxy)
@@ -346,10 +441,10 @@ class TCP_Resolver(BaseResolver):
 
 class Resolver(BaseResolver):
     def __init__(self, dnsserver, proxy=None):
-        self.dnsserver = dnsserver
+        self.dnsserver = tuple(dnsserver)
         self.UDP_Resolver = UDP_Resolver(dnsserver)
         self.TCP_Resolver = TCP_Resolver(dnsserver, proxy)
-        self.hostlock = defaultdict(RLock)
+        self.hostlock = keyed_lock('resolver.host')
 
     def _record(self, domain, qtype):
         record = self.UDP_Resolver.record(domain, qtype)
@@ -364,7 +459,7 @@ class Anti_GFW_Resolver(BaseResolver):
         self.remote = TCP_Resolver(remotedns, proxy)
         self.apfilter_list = apfilter_list
         self.bad_ip = bad_ip
-        self.hostlock = defaultdict(RLock)
+        self.hostlock = keyed_lock('resolver.host')
 
     def _record(self, domain, qtype):
         try:
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding:utf-8
+#
+# scorer.py  rank parent proxies for get_proxy.parentproxy
+#
+# scores are costs: lower is better, on the same scale as httppriority.
+# size: expected bytes of the transfer, if known. transfers larger than
+#       bulk_size are charged the time needed at parent's throughput.
+
+from __future__ import division
+
+import math
+import random
+import logging
+
+logger = logging.getLogger('scorer')
+logger.setLevel(logging.INFO)
+hdr = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
+                              datefmt='%H:%M:%S')
+hdr.setFormatter(formatter)
+logger.addHandler(hdr)
+
+
+class classic_scorer(object):
+    '''static priority, location and EWMA of response time. the original behavior.'''
+    name = 'classic'
+    TRANSFER_WEIGHT = 1  # per second
+    TRANSFER_MAX = 60
+
+    def __init__(self, conf=None):
+        self.conf = conf
+        self.bulk_size = conf.userconf.dgetint('fgfwproxy', 'bulk_size', 1048576) if conf else 1048576
+        self._mean_throughput = 0  # of parents last sorted, throughput known
+
+    def transfer(self, parent, size):
+        '''
+        cost of moving size bytes through parent, 0 for small or unknown transfer.
+        a parent of unknown throughput is charged the mean of the known ones,
+        or it would be preferred for bulk transfers over every measured parent.
+        '''
+        throughput = parent.stats.throughput or self._mean_throughput
+        if not size or size < self.bulk_size or not throughput:
+            return 0
+        return min(size / throughput, self.TRANSFER_MAX) * self.TRANSFER_WEIGHT
+
+    def breakdown(self, parent, command, host, location, size=None):
+        result = {'priority': parent.base_priority(command, location),
+                  'resp_time': (parent.get_avg_resp_time() + parent.get_avg_resp_time(host)) * 5,
+                  'transfer': self.transfer(parent, size),
+                  }
+        return result
+
+    def score(self, parent, command, host, location, size=None):
+        return sum(self.breakdown(parent, command, host, location, size).values())
+
+    def sort(self, parentlist, command, host, location, size=None):
+        if len(parentlist) < 2:
+            return parentlist
+        known = [parent.stats.throughput for parent in parentlist if parent.stats.throughput]
+        self._mean_throughput = sum(known) / len(known) if known else 0
+        random.shuffle(parentlist)
+        # least outstanding requests breaks ties
+        return sorted(parentlist, key=lambda parent: (self.score(parent, command, host, location, size), parent.stats.inflight))
+
+
+class multi_metric_scorer(classic_scorer):
+    '''
+    latency percentiles, throughput, failure ratio and in-flight count.
+    '''
+    name = 'multi'
+    LATENCY_WEIGHT = 5
+    TAIL_WEIGHT = 1
+    FAILURE_WEIGHT = 20
+    INFLIGHT_WEIGHT = 0.5
+    THROUGHPUT_WEIGHT = 1
+    THROUGHPUT_BASE = 131072  # bytes/s, below this, no bonus
+
+    def breakdown(self, parent, command, host, location, size=None):
+        stats = parent.stats
+        result = {'priority': parent.base_priority(command, location),
+                  'latency': (stats.percentile(50) + parent.get_avg_resp_time(host)) * self.LATENCY_WEIGHT,
+                  'tail': stats.percentile(95) * self.TAIL_WEIGHT,
+                  'failure': stats.failure_ratio * self.FAILURE_WEIGHT,
+                  'inflight': stats.inflight * self.INFLIGHT_WEIGHT,
+                  'throughput': 0,
+                  'transfer': self.transfer(parent, size),
+                  }
+        if stats.throughput > self.THROUGHPUT_BASE:
+            result['throughput'] = -min(math.log(stats.throughput / self.THROUGHPUT_BASE, 2), 5) * self.THROUGHPUT_WEIGHT
+        return result
+
+
+class ucb_scorer(multi_metric_scorer):
+    '''
+    multi_metric_scorer with an upper confidence bound exploration bonus:
+    parents rarely selected lately (recovering from failure, for example)
+    get their cost lowered, so they are retried from time to time.
+    '''
+    name = 'ucb'
+    EXPLORATION = 4
+
+    def __init__(self, conf=None):
+        multi_metric_scorer.__init__(self, conf)
+        self._total = 1
+
+    def breakdown(self, parent, command, host, location, size=None):
+        result = multi_metric_scorer.breakdown(self, parent, command, host, location, size)
+        n = parent.stats.selected
+        result['exploration'] = -self.EXPLORATION * math.sqrt(2 * math.log(max(self._total, 2)) / (n + 1))
+        return result
+
+    def sort(self, parentlist, command, host, location, size=None):
+        self._total = sum(parent.stats.selected for parent in parentlist) + 1
+        return multi_metric_scorer.sort(self, parentlist, command, host, location, size)
+
+
+class epsilon_scorer(multi_metric_scorer):
+    '''multi_metric_scorer, but with probability EPSILON, a random parent goes first.'''
+    name = 'epsilon'
+    EPSILON = 0.05
+
+    def sort(self, parentlist, command, host, location, size=None):
+        parentlist = multi_metric_scorer.sort(self, parentlist, command, host, location, size)
+        if len(parentlist) > 1 and random.random() < self.EPSILON:
+            parentlist.insert(0, parentlist.pop(random.randrange(1, len(parentlist))))
+            logger.debug('explore parent %s' % parentlist[0].name)
+        return parentlist
+
+
+SCORERS = dict((cls.name, cls) for cls in (classic_scorer, multi_metric_scorer, ucb_scorer, epsilon_scorer))
+
+
+def get_scorer(name, conf=None):
+    if name not in SCORERS:
+        logger.warning('unknown scorer %s, using classic' % name)
+        name = 'classic'
+    return SCORERS[name](conf)
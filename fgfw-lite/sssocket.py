@@ -7,6 +7,7 @@ import hmac
 import io
 from parent_proxy import ParentProxy
 from basesocket import basesocket
+from connection import tfo_check
 
 
 class sssocket(basesocket):
@@ -26,14 +27,14 @@ class sssocket(basesocket):
         self._ota_chunk_idx = 0
         self.connected = False
 
-    def connect(self, address):
+    def connect(self, address, deadline=None):
         self.__address = address
         sshost, ssport, ssmethod, sspassword = (self.ssServer.hostname, self.ssServer.port, self.ssServer.username.lower(), self.ssServer.password)
-        from connection import create_connection
+        from connection import create_connection, WARM_POOL
         if ssmethod.endswith('-auth'):
             self.__ota = True
             ssmethod = ssmethod[:-5]
-        self._sock = create_connection((sshost, ssport), self.timeout, parentproxy=self.parentproxy, tunnel=True)
+        self._sock = WARM_POOL.get(self.ssServer, self.timeout) or create_connection((sshost, ssport), self.timeout, parentproxy=self.parentproxy, tunnel=True, tfo=self.ssServer.tfo, uplink=self.ssServer.uplink, deadline=deadline)
         self.crypto = encrypt.Encryptor(sspassword, ssmethod)
 
     def recv(self, size):
@@ -48,6 +49,7 @@ class sssocket(basesocket):
             data = self._sock.recv(self.bufsize)
             if not data:
                 return b''
+            tfo_check(self._sock)
             data = self.crypto.decrypt(data)
             if len(data) <= size:
                 return data
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding:utf-8
+#
+# state_store.py  keep learned routing state across restarts
+#
+# saved: temp autoproxy rules with expire timestamp,
+#        response time of parent proxies (per host),
+#        rolling stats of parent proxies.
+
+import os
+import json
+import time
+import logging
+from threading import Timer, RLock
+
+logger = logging.getLogger('state_store')
+logger.setLevel(logging.INFO)
+hdr = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
+                              datefmt='%H:%M:%S')
+hdr.setFormatter(formatter)
+logger.addHandler(hdr)
+
+VERSION = 1
+HOST_TTL = 86400  # response time by host older than this is not saved
+
+
+class state_store(object):
+    def __init__(self, conf, path='./fgfw-lite/state.json', interval=300):
+        self.conf = conf
+        self.path = path
+        self.interval = interval
+        self.lock = RLock()
+        if self.interval:
+            t = Timer(self.interval, self._sched_save, ())
+            t.daemon = True
+            t.start()
+
+    def snapshot(self):
+        now = time.time()
+        local = self.conf.PARENT_PROXY.local
+        rules = [(rule, round(exp, 1)) for rule, exp in list(local.expire_at.items()) if exp > now]
+        parents = {}
+        for name, parent in list(self.conf.parentlist.dict.items()):
+            by_host = {}
+            for host, ts in list(parent.avg_resp_time_by_host_ts.items()):
+                if now - ts < HOST_TTL and parent.avg_resp_time_by_host[host]:
+                    by_host[host] = (round(parent.avg_resp_time_by_host[host], 3), round(ts, 1))
+            parents[name] = {'avg_resp_time': (round(parent.avg_resp_time, 3), round(parent.avg_resp_time_ts, 1)),
+                             'by_host': by_host,
+                             'stats': parent.stats.dump(),
+                             }
+        return {'version': VERSION, 'time': round(now, 1), 'rules': rules, 'parents': parents}
+
+    def save(self):
+        with self.lock:
+            try:
+                data = json.dumps(self.snapshot(), separators=(',', ':'))
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    f.write(data)
+                if os.path.exists(self.path):
+                    # os.rename does not overwrite on windows
+                    os.remove(self.path)
+                os.rename(tmp, self.path)
+                logger.debug('state saved, %d bytes' % len(data))
+            except Exception as e:
+                logger.warning('save state failed: %r' % e)
+
+    def load(self, rules_only=False):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') != VERSION:
+                return
+        except Exception as e:
+            logger.warning('%s is corrupted: %r' % (self.path, e))
+            return
+        now = time.time()
+        count = 0
+        for rule, exp in data.get('rules', []):
+            if exp > now and rule not in self.conf.PARENT_PROXY.local.rules:
+                self.conf.PARENT_PROXY.add_temp(rule, (exp - now) / 60, quiet=True)
+                count += 1
+        if rules_only:
+            logger.info('%d temp rules restored' % count)
+            return
+        for name, v in data.get('parents', {}).items():
+            parent = self.conf.parentlist.get(name)
+            if parent is None:
+                continue
+            parent.avg_resp_time, parent.avg_resp_time_ts = v['avg_resp_time']
+            for host, (rtime, ts) in v.get('by_host', {}).items():
+                parent.avg_resp_time_by_host[host] = rtime
+                parent.avg_resp_time_by_host_ts[host] = ts
+            parent.stats.restore(v.get('stats', {}))
+        logger.info('state loaded, %d temp rules restored' % count)
+
+    def _sched_save(self):
+        self.save()
+        t = Timer(self.interval, self._sched_save, ())
+        t.daemon = True
+        t.start()
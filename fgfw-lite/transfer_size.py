@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding:utf-8
+#
+# transfer_size.py  guess how many bytes a request will transfer
+#
+# learned from traffic of finished requests, per host and per url pattern.
+# pattern: host and file extension (example.com/*.mp4),
+#          or host and first path segment (example.com/download/).
+# Range and Content-Length request headers take precedence.
+
+import re
+import posixpath
+from threading import RLock
+from collections import OrderedDict
+
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+
+
+def url_pattern(host, path):
+    if not path or not path.startswith(('http://', 'https://', '/')):
+        return None
+    path = urlparse.urlparse(path).path if '://' in path else path.partition('?')[0]
+    ext = posixpath.splitext(path)[1].lower()
+    if ext and len(ext) <= 6:
+        return '%s/*%s' % (host, ext)
+    segment = path.strip('/').partition('/')[0]
+    if segment and not segment.isdigit():
+        return '%s/%s/' % (host, segment)
+    return None
+
+
+class size_estimator(object):
+    ALPHA = 0.3  # weight of the last sample
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.table = OrderedDict()  # {key: EWMA of bytes}
+        self.lock = RLock()
+
+    def _update(self, key, nbytes):
+        old = self.table.pop(key, None)
+        self.table[key] = nbytes if old is None else (1 - self.ALPHA) * old + self.ALPHA * nbytes
+        if len(self.table) > self.size:
+            self.table.popitem(last=False)
+
+    def learn(self, host, path, nbytes):
+        if not nbytes:
+            return
+        with self.lock:
+            self._update(host, nbytes)
+            pattern = url_pattern(host, path)
+            if pattern:
+                self._update(pattern, nbytes)
+
+    def estimate(self, host, path=None, headers=None):
+        '''bytes expected, None if unknown'''
+        if headers is not None:
+            m = re.match(r'bytes=(\d+)-(\d*)$', headers.get('Range', '').strip())
+            if m and m.group(2):
+                return int(m.group(2)) - int(m.group(1)) + 1
+            if int(headers.get('Content-Length', 0) or 0):
+                return int(headers['Content-Length'])
+        pattern = url_pattern(host, path)
+        with self.lock:
+            if pattern in self.table:
+                return self.table[pattern]
+            return self.table.get(host)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding:utf-8
+#
+# uplink.py  spread outbound connections across several local addresses / interfaces
+#
+# [uplinks]
+# name = <source ip, or * for any> <optional int: weight> <optional str: interface>
+# wan1 = 192.168.1.2 3
+# wan2 = 10.0.0.2 1 eth1
+#
+# parents pick uplinks with ?uplink=wan1|wan2, direct connections with fgfwproxy/uplink.
+# default is all uplinks. new connections are spread by smooth weighted round robin,
+# weight is scaled by observed throughput and lowered after connect failures.
+
+import time
+import socket
+import logging
+from threading import RLock
+from collections import OrderedDict
+
+logger = logging.getLogger('uplink')
+logger.setLevel(logging.INFO)
+hdr = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
+                              datefmt='%H:%M:%S')
+hdr.setFormatter(formatter)
+logger.addHandler(hdr)
+
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+FAILURE_DECAY = 60  # seconds, a failure counts half after this
+
+
+class uplink(object):
+    def __init__(self, name, conf):
+        '''conf: "<source ip or *> <optional int: weight> <optional str: interface>"'''
+        args = conf.split()
+        self.name = name
+        address = args[0] if args else '*'
+        self.source_address = None if address == '*' else (address, 0)
+        self.family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        self.weight = int(args[1]) if len(args) > 1 else 1
+        self.device = args[2] if len(args) > 2 else None
+        self.current = 0  # smooth weighted round robin state
+        self.throughput = 0  # EWMA of bytes/s
+        self.failures = 0
+        self.last_failure = 0
+        self.selected = 0
+
+    def bind(self, sock, af):
+        '''bind sock to this uplink, address only if it's the same family'''
+        if self.device:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.device.encode() + b'\0')
+        if self.source_address and af == self.family:
+            sock.bind(self.source_address)
+
+    def log(self, nbytes, duration):
+        # short transfers tell nothing about bandwidth
+        if nbytes > 65536 and duration > 0.1:
+            rate = nbytes / duration
+            self.throughput = 0.7 * self.throughput + 0.3 * rate if self.throughput else rate
+
+    def failed(self):
+        self.failures = self._failures() + 1
+        self.last_failure = time.time()
+
+    def _failures(self):
+        if not self.failures:
+            return 0
+        return self.failures * 0.5 ** ((time.time() - self.last_failure) / FAILURE_DECAY)
+
+    def effective_weight(self, mean_throughput):
+        w = float(self.weight)
+        if self.throughput and mean_throughput:
+            w *= min(max(self.throughput / mean_throughput, 0.5), 2)
+        return w * 0.5 ** self._failures()
+
+    def dump(self):
+        return {'source_address': self.source_address[0] if self.source_address else '*',
+                'device': self.device,
+                'weight': self.weight,
+                'throughput': round(self.throughput),
+                'failures': round(self._failures(), 2),
+                'selected': self.selected,
+                }
+
+
+class uplink_balancer(object):
+    def __init__(self):
+        self.links = OrderedDict()
+        self.by_address = {}
+        self.adhoc = {}  # source addresses used by parents, not in [uplinks]
+        self.lock = RLock()
+
+    def add(self, name, conf):
+        link = uplink(name, conf)
+        self.links[name] = link
+        if link.source_address:
+            self.by_address[link.source_address[0]] = link
+        logger.info('add uplink: %s: %s' % (name, conf))
+
+    def select(self, policy=None):
+        '''
+        policy: list of uplink names or source addresses, all uplinks if empty.
+        return an uplink, or None if none configured.
+        '''
+        if not policy and not self.links:
+            return None
+        with self.lock:
+            if policy:
+                links = [self.links.get(name) or self.by_address.get(name) or self._address(name) for name in policy]
+                links = [link for link in links if link]
+            else:
+                links = list(self.links.values())
+            if not links:
+                return None
+            if len(links) == 1:
+                best = links[0]
+            else:
+                known = [link.throughput for link in links if link.throughput]
+                mean = sum(known) / len(known) if known else 0
+                total = 0
+                best = None
+                for link in links:
+                    w = link.effective_weight(mean)
+                    link.current += w
+                    total += w
+                    if best is None or link.current > best.current:
+                        best = link
+                best.current -= total
+            best.selected += 1
+            return best
+
+    def _address(self, address):
+        '''a source address not in [uplinks], weight 1'''
+        if address in self.adhoc:
+            return self.adhoc[address]
+        for af in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(af, address)
+            except (socket.error, ValueError):
+                continue
+            link = self.adhoc[address] = self.by_address[address] = uplink(address, address)
+            return link
+        logger.warning('uplink %s not found' % address)
+
+    def lookup(self, sock):
+        '''uplink a connected socket goes out from, by source address'''
+        if not self.by_address or sock is None:
+            return None
+        try:
+            return self.by_address.get(sock.getsockname()[0])
+        except Exception:
+            return None
+
+    def dump(self):
+        with self.lock:
+            result = dict((name, link.dump()) for name, link in self.adhoc.items())
+            result.update((name, link.dump()) for name, link in self.links.items())
+            return result
+
+
+UPLINKS = uplink_balancer()
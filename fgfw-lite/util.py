@@ -19,7 +19,17 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 import re
+import time
+import bisect
 import select
+import socket
+import hashlib
+from threading import RLock, Lock
+from collections import OrderedDict, namedtuple
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
 try:
     import configparser
 except ImportError:
@@ -83,6 +93,37 @@ def parse_hostport(host, default_port=80):
         return host.strip('[]'), default_port
 
 
+class request_context(namedtuple('request_context', 'url scheme host port path labels suffixes')):
+    '''
+    request url parsed once, shared by redirector, get_proxy and ap_filter.
+    host: lower-cased, without port
+    labels: reversed host labels, ('com', 'google', 'www')
+    suffixes: ('www.google.com', 'google.com', 'com'), for domain rules
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_parse(cls, url, parse, requesthost=None):
+        host, port = requesthost or (parse.hostname or '', parse.port or 80)
+        return cls._new(url, parse.scheme.lower(), host, port, parse.path)
+
+    @classmethod
+    def from_url(cls, url, host=None):
+        '''url: http://www.google.com/, or www.google.com:443 for CONNECT'''
+        if '://' in url:
+            parse = urlparse.urlparse(url)
+            return cls._new(url, parse.scheme.lower(), host or parse.hostname or '', parse.port or 80, parse.path)
+        hostname, port = parse_hostport(url, 443)
+        return cls._new(url, '', host or hostname, port, '')
+
+    @classmethod
+    def _new(cls, url, scheme, host, port, path):
+        host = host.lower()
+        labels = host.split('.')
+        suffixes = tuple('.'.join(labels[i:]) for i in range(len(labels)))
+        return cls(url, scheme, host, port, path, tuple(reversed(labels)), suffixes)
+
+
 def is_connection_dropped(lst):  # modified from urllib3
     """
     Returns sockets that is dropped and should be closed.
@@ -103,6 +144,276 @@ def sizeof_fmt(num):
         num /= 1024.0
     return "%.1f%s" % (num, 'TB')
 
+
+class connect_deadline(object):
+    '''
+    absolute time limit of a connection attempt, shared by every hop of a via chain
+    and every handshake on the way, so a failing path gives up in time.
+    '''
+    def __init__(self, timeout):
+        self.expire = time.time() + timeout if timeout else None
+
+    def remaining(self):
+        '''seconds left, raise socket.timeout if passed'''
+        if self.expire is None:
+            return None
+        left = self.expire - time.time()
+        if left <= 0:
+            raise socket.timeout('deadline exceeded')
+        return left
+
+    def apply(self, sock):
+        '''set timeout of sock to the time left'''
+        sock.settimeout(self.remaining())
+        return sock
+
+
+class budget(object):
+    '''
+    token bucket: earn *ratio* token for each deposit, spend one for each withdraw.
+    also earn *per_sec* token each second, so low traffic is not starved.
+    '''
+    def __init__(self, ratio=0.1, per_sec=0, maximum=10):
+        self.ratio = ratio
+        self.per_sec = per_sec
+        self.maximum = maximum
+        self.tokens = maximum
+        self.ts = time.time()
+        self.lock = RLock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self.ts) * self.per_sec, self.maximum)
+        self.ts = now
+
+    def deposit(self, n=1):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens + self.ratio * n, self.maximum)
+
+    def withdraw(self):
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def refund(self):
+        with self.lock:
+            self.tokens = min(self.tokens + 1, self.maximum)
+
+
+class keyed_budget(object):
+    '''a budget for each key, least recently used keys are dropped'''
+    def __init__(self, ratio=0.1, per_sec=0, maximum=10, size=1024):
+        self.args = (ratio, per_sec, maximum)
+        self.size = size
+        self.budgets = OrderedDict()
+        self.lock = RLock()
+
+    def get(self, key):
+        with self.lock:
+            b = self.budgets.pop(key, None)
+            if b is None:
+                b = budget(*self.args)
+                if len(self.budgets) >= self.size:
+                    self.budgets.popitem(last=False)
+            self.budgets[key] = b
+            return b
+
+    def deposit(self, key, n=1):
+        self.get(key).deposit(n)
+
+    def withdraw(self, key):
+        return self.get(key).withdraw()
+
+    def refund(self, key):
+        self.get(key).refund()
+
+
+class lock_stat(object):
+    '''wait / hold time of all locks with the same name'''
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.wait = 0
+        self.wait_max = 0
+        self.hold = 0
+        self.hold_max = 0
+        self.lock = Lock()
+
+    def log(self, wait, hold, contended):
+        with self.lock:
+            self.acquired += 1
+            self.contended += contended
+            self.wait += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.hold += hold
+            self.hold_max = max(self.hold_max, hold)
+
+    def dump(self):
+        n = self.acquired or 1
+        return {'acquired': self.acquired,
+                'contended': self.contended,
+                'wait_avg_ms': round(self.wait * 1000 / n, 3),
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'wait_total_ms': round(self.wait * 1000, 1),
+                'hold_avg_ms': round(self.hold * 1000 / n, 3),
+                'hold_max_ms': round(self.hold_max * 1000, 3),
+                }
+
+
+LOCK_STATS = {}
+
+
+def lock_stats():
+    return dict((name, stat.dump()) for name, stat in LOCK_STATS.items())
+
+
+class stat_lock(object):
+    '''
+    RLock with a name. if stat_lock.ENABLED, time spent waiting for and holding it
+    is recorded in LOCK_STATS[name], served at /api/locks.
+    '''
+    ENABLED = False
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = RLock()
+        self._depth = 0
+        self._wait = 0
+        self._contended = False
+        self._since = 0
+
+    def acquire(self, blocking=True):
+        if not self.ENABLED:
+            if self._lock.acquire(blocking):
+                self._depth += 1
+                return True
+            return False
+        start = time.time()
+        contended = not self._lock.acquire(False)
+        if contended:
+            if not blocking:
+                return False
+            self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            self._since = time.time()
+            self._wait = self._since - start
+            self._contended = contended
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._since:
+            hold = time.time() - self._since
+            self._since = 0
+            stat = LOCK_STATS.get(self.name) or LOCK_STATS.setdefault(self.name, lock_stat())
+            stat.log(self._wait, hold, self._contended)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class keyed_lock(object):
+    '''
+    a lock for each key, like defaultdict(RLock), but a lock is dropped once no one
+    holds or waits for it. the key table is sharded by key hash, so threads working
+    on different keys rarely meet on the same mutex.
+    '''
+    SHARDS = 16
+
+    def __init__(self, name):
+        self.name = name
+        self.shards = [(Lock(), {}) for _ in range(self.SHARDS)]
+
+    def __getitem__(self, key):
+        return _keyed_lock_entry(self, key)
+
+    def __len__(self):
+        return sum(len(table) for _, table in self.shards)
+
+
+class _keyed_lock_entry(object):
+    def __init__(self, keyed, key):
+        self.shard = keyed.shards[hash(key) % len(keyed.shards)]
+        self.name = keyed.name
+        self.key = key
+        self.entry = None
+
+    def __enter__(self):
+        mutex, table = self.shard
+        with mutex:
+            entry = table.get(self.key)
+            if entry is None:
+                entry = table[self.key] = [stat_lock(self.name), 0]
+            entry[1] += 1
+        self.entry = entry
+        entry[0].acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        mutex, table = self.shard
+        self.entry[0].release()
+        with mutex:
+            self.entry[1] -= 1
+            if not self.entry[1]:
+                del table[self.key]
+
+
+def base_domain(host):
+    '''www.google.com -> google.com, www.bbc.co.uk -> bbc.co.uk, ip address unchanged'''
+    if ':' in host or host.replace('.', '').isdigit():
+        return host
+    labels = host.split('.')
+    if len(labels) > 2 and labels[-2] in ('com', 'net', 'org', 'gov', 'edu', 'co', 'ac', 'ne', 'or'):
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+class hash_ring(object):
+    '''
+    consistent hashing, each node has *replicas* points on the ring.
+    adding or removing a node only moves keys next to its points.
+    '''
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = tuple(nodes)
+        ring = []
+        for node in self.nodes:
+            for i in range(replicas):
+                ring.append((self._hash('%s#%d' % (node, i)), node))
+        ring.sort()
+        self.keys = [k for k, _ in ring]
+        self.ring = [n for _, n in ring]
+
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def iter_nodes(self, key):
+        '''nodes in ring order, starting from where key falls'''
+        if not self.ring:
+            return
+        start = bisect.bisect(self.keys, self._hash(key))
+        seen = set()
+        for i in range(len(self.ring)):
+            node = self.ring[(start + i) % len(self.ring)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
 try:
     GeoIP2 = geoip2.database.Reader('./fgfw-lite/GeoLite2-Country.mmdb', mode=geoip2.database.MODE_MEMORY) if geoip2 else None
 except Exception:
@@ -0,0 +1,47 @@
+# coding: UTF-8
+import os
+import sys
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fgfw-lite'))
+
+from httputil import httpconn_pool
+
+
+class HttpconnPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = httpconn_pool('test')
+        self.soc, self.peer = socket.socketpair()
+
+    def tearDown(self):
+        self.soc.close()
+        self.peer.close()
+
+    def assert_disabled(self):
+        self.pool.put('upstream', self.soc, 'direct')
+        self.assertEqual(len(self.pool), 0)
+        self.assertIsNone(self.pool.get('upstream'))
+        # closed, not kept
+        self.assertRaises(socket.error, self.soc.send, b'x')
+
+    def test_max_size_zero(self):
+        self.pool.MAX_SIZE = 0
+        self.assert_disabled()
+
+    def test_max_per_upstream_zero(self):
+        self.pool.MAX_PER_UPSTREAM = 0
+        self.assert_disabled()
+
+    def test_evict_per_upstream(self):
+        self.pool.MAX_PER_UPSTREAM = 1
+        soc, peer = socket.socketpair()
+        self.pool.put('upstream', soc, 'direct')
+        self.pool.put('upstream', self.soc, 'direct')
+        self.assertEqual(len(self.pool), 1)
+        self.assertIs(self.pool.get('upstream')[0], self.soc)
+        peer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# coding: UTF-8
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'fgfw-lite'))
+
+# config creates userconf.ini and fgfw-lite/local.txt in working directory, keep them out of the tree
+WORK = tempfile.mkdtemp()
+shutil.copy(os.path.join(ROOT, 'userconf.sample.ini'), WORK)
+shutil.copytree(os.path.join(ROOT, 'fgfw-lite'), os.path.join(WORK, 'fgfw-lite'),
+                ignore=shutil.ignore_patterns('*.py', '*.pyc', 'ui', 'lang'))
+os.chdir(WORK)
+
+import config  # noqa: apfilter and get_proxy import each other through config
+from redirector import redirector
+
+
+def tearDownModule():
+    os.chdir(ROOT)
+    shutil.rmtree(WORK, ignore_errors=True)
+
+
+class request(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class RedirectorTest(unittest.TestCase):
+    def setUp(self):
+        self.redir = redirector(config.conf)
+
+    def test_remove_redirect(self):
+        self.redir.add_redirect('|https://x.com/', '/foo/')
+        self.assertEqual(self.redir.redirect(request('https://x.com/')), 'foo')
+        rule, dest = self.redir.remove_redirect(0)
+        self.assertEqual((rule.rule, dest), ('|https://x.com/', '/foo/'))
+        self.assertEqual(self.redir.redirlst, [])
+        self.assertIsNone(self.redir.redirect(request('https://x.com/')))
+        # added again, indexed once
+        self.redir.add_redirect('|https://x.com/', 'http://y.com/')
+        self.assertEqual(len(self.redir.redir_index['x.com']), 1)
+        self.assertEqual(self.redir.redirect(request('https://x.com/')), 'http://y.com/')
+
+    def test_remove_global_redirect(self):
+        self.redir.add_redirect('/x\\.com/', 'http://y.com/')
+        self.redir.add_redirect('||z.com^', 'http://y.com/')
+        self.redir.remove_redirect(0)
+        self.assertIsNone(self.redir.redirect(request('https://x.com/')))
+        self.assertEqual(self.redir.redirect(request('https://z.com/')), 'http://y.com/')
+
+    def test_prefix_without_host_boundary(self):
+        self.assertIsNone(self.redir.rule_host('|http://example'))
+        self.assertEqual(self.redir.rule_host('|http://example.com/'), 'example.com')
+        self.redir.add_redirect('|http://example', 'http://y.com/')
+        self.assertEqual(self.redir.redirect(request('http://example.com.cn/')), 'http://y.com/')
+
+
+if __name__ == '__main__':
+    unittest.main()